@@ -0,0 +1,297 @@
+from parser import read_fingerprinted
+from file_utils import fingerprint_matches
+from parser_tokenize import Line, LineParseError
+from type_utils import datetime_from_str
+
+import cPickle as pickle
+import cStringIO
+import hashlib
+import os
+import struct
+
+
+# properties importers use to record the bank's id of a transaction
+bank_id_keys = ('ofxid', 'ofx_id', 'bankid', 'bank_id')
+
+_bank_id_prefixes = tuple(key + ':' for key in bank_id_keys)
+
+
+# bump whenever the pickled index changes shape
+_bank_index_version = 2
+
+
+# the index for 'dir/ledger.dat' lives in 'dir/.ledger.dat.bankids'
+def bank_index_path(filename):
+    (dirname, basename) = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.bankids')
+
+
+# the key of a bank id in the index and its Bloom filter; ledger text is read
+# as bytes, so unicode is looked up by its UTF-8 encoding
+def _key(account, bank_id):
+    if isinstance(account, unicode):
+        account = account.encode('utf-8')
+    if isinstance(bank_id, unicode):
+        bank_id = bank_id.encode('utf-8')
+    return account + '\0' + bank_id
+
+
+# A Bloom filter over (account, bank id) keys: a miss means the key was never
+# added, a hit only that it probably was.  With 10 bits per key about 1% of
+# misses show up as hits.
+class BloomFilter(object):
+    def __init__(self, n, bits_per_key=10):
+        self.nbits = max(64, n*bits_per_key)
+        self.nhashes = max(1, int(bits_per_key*0.69))
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    def _positions(self, key):
+        (h1, h2) = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i*h2) % self.nbits for i in xrange(self.nhashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+# what the index knows about one file of the import tree; its bank ids are
+# kept apart (see BankIndex) so they are only loaded when needed
+class _FileEntry(object):
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.imports     = []   # paths of the imported files, in order
+        self.accounts    = []   # names of the accounts declared
+        self.categories  = []   # names of the categories declared
+
+
+# Scans one file of the import tree for declarations, imports and bank ids
+# without parsing it; returns (_FileEntry, ids) where ids maps the _key() of
+# each account and bank id to the line number of its transaction.  Lines the
+# parser would reject are skipped: the index only ever narrows down which
+# transactions to look at, and parsing the ledger reports the errors.
+def scan_file(path):
+    (text, fingerprint) = read_fingerprinted(path)
+    entry = _FileEntry(fingerprint)
+    ids = _scan_lines(entry, path, cStringIO.StringIO(text))
+    return (entry, ids)
+
+# scans the lines of path after the first linenum into entry, returning ids
+def _scan_lines(entry, path, lines, linenum=0):
+    ids = {}
+    header = None    # (line number, raw line) of the current transaction
+    account = None   # its account, once a bank id needed it
+    for (linenum, rawline) in enumerate(lines, linenum + 1):
+        if rawline[:1] in (' ', '\t'):
+            if header is None or not rawline.lstrip().startswith(_bank_id_prefixes):
+                continue
+            try:
+                tokens = Line(rawline).token_values()
+            except LineParseError:
+                continue
+            if len(tokens) != 2 or tokens[0][:-1] not in bank_id_keys:
+                continue
+            if account is None:
+                try:
+                    htokens = Line(header[1]).token_values()
+                except LineParseError:
+                    htokens = ()
+                if len(htokens) != 5 or not datetime_from_str(htokens[0]):
+                    header = None
+                    continue
+                account = htokens[3]
+            ids[_key(account, tokens[1])] = header[0]
+            continue
+
+        if rawline.isspace() or rawline.lstrip().startswith('#'):
+            if rawline.isspace():
+                header = None
+            continue
+        header = (linenum, rawline)
+        account = None
+        if rawline[:1].isdigit():
+            continue
+        header = None
+        try:
+            tokens = Line(rawline).token_values()
+        except LineParseError:
+            continue
+        cmd = tokens[0].lower() if tokens else None
+        if cmd == 'account' and len(tokens) in (2, 3):
+            entry.accounts.append(tokens[1])
+        elif cmd == 'category' and len(tokens) in (2, 3):
+            entry.categories.append(tokens[1])
+        elif cmd == 'import' and len(tokens) == 2:
+            ipath = os.path.expanduser(tokens[1])
+            if not os.path.isabs(ipath):
+                ipath = os.path.join(os.path.dirname(path), ipath)
+            entry.imports.append(ipath)
+    return ids
+
+
+# A persistent index of the bank ids of the transactions in a ledger import
+# tree, kept next to the ledger ('dir/.ledger.dat.bankids') and updated file
+# by file: only files whose fingerprint changed are rescanned.  It also knows
+# the account and category names declared in the tree, which is enough to
+# import into the ledger without parsing it.
+#
+# The index is stored as two pickles: a small header with the file entries
+# and a Bloom filter of every (account, bank id), then the ids themselves.
+# Lookups that miss the filter, the usual case for new transactions, never
+# load the ids.
+class BankIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.files    = {}     # map of paths to _FileEntrys
+        self.order    = []     # paths of the import tree, in import order
+        self.bloom    = BloomFilter(0)
+        self._ids     = None   # map of paths to scan_file() ids, or None until loaded
+        self._stamp   = None   # ties the stored ids to the stored header
+        self._offset  = None   # where the stored ids start
+        self._read_header()
+
+    def _read_header(self):
+        try:
+            with open(bank_index_path(self.filename), 'rb') as fp:
+                (version, filename, stamp, files, bloom) = pickle.load(fp)
+                offset = fp.tell()
+        except Exception:
+            return
+        if version != _bank_index_version or filename != self.filename:
+            return
+        (self.files, self.bloom, self._stamp, self._offset) = (files, bloom, stamp, offset)
+
+    def _read_ids(self):
+        if self._offset is None:
+            return None
+        try:
+            with open(bank_index_path(self.filename), 'rb') as fp:
+                fp.seek(self._offset)
+                (stamp, ids) = pickle.load(fp)
+        except Exception:
+            return None
+        return ids if stamp == self._stamp else None
+
+    # the bank ids of every file, loading them from the stored index the
+    # first time; if they can't be loaded every file gets rescanned
+    def ids(self):
+        if self._ids is None:
+            self._ids = self._read_ids()
+            if self._ids is None:
+                self._ids = {}
+                if self.files:
+                    self.files = {}
+                    self.refresh()
+        return self._ids
+
+    # rescans the files of the import tree that changed since the index was
+    # saved, drops those no longer imported, and saves the index if anything
+    # changed.  Imported files that can't be read are left out.
+    def refresh(self):
+        self.order = []
+        changed = []
+        seen = set()
+        def visit(path):
+            if path in seen:
+                return
+            seen.add(path)
+            entry = self.files.get(path)
+            if entry is None or not fingerprint_matches(path, entry.fingerprint):
+                try:
+                    (entry, ids) = scan_file(path)
+                except (IOError, OSError):
+                    if path == self.filename:
+                        raise
+                    return
+                changed.append((path, entry, ids))
+            self.order.append(path)
+            for ipath in entry.imports:
+                visit(ipath)
+        visit(self.filename)
+
+        dropped = set(self.files) - seen
+        if not changed and not dropped:
+            return
+        all_ids = self.ids()
+        for (path, entry, ids) in changed:
+            self.files[path] = entry
+            all_ids[path] = ids
+        for path in dropped:
+            self.files.pop(path, None)
+            all_ids.pop(path, None)
+        self._rebuild_bloom()
+        self.save()
+
+    def _rebuild_bloom(self):
+        all_ids = self.ids()
+        self.bloom = BloomFilter(sum(len(ids) for ids in all_ids.itervalues()))
+        for ids in all_ids.itervalues():
+            for key in ids:
+                self.bloom.add(key)
+
+    # writes the index; failures are not fatal since it can always be rebuilt
+    def save(self):
+        path = bank_index_path(self.filename)
+        tmp_path = path + '_'
+        stamp = os.urandom(8)
+        try:
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump((_bank_index_version, self.filename, stamp, self.files, self.bloom),
+                        fp, pickle.HIGHEST_PROTOCOL)
+                offset = fp.tell()
+                pickle.dump((stamp, self.ids()), fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+            (self._stamp, self._offset) = (stamp, offset)
+        except (IOError, OSError, pickle.PicklingError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # records text appended to path, given the file's fingerprint and number
+    # of lines before and its fingerprint after; if the index wasn't current
+    # for the file it is left to be rescanned by the next refresh()
+    def appended(self, path, fingerprint, linenum, text, new_fingerprint):
+        all_ids = self.ids()
+        entry = self.files.get(path)
+        if entry is None or entry.fingerprint != fingerprint:
+            return
+        ids = all_ids.setdefault(path, {})
+        new_ids = _scan_lines(entry, path, text.splitlines(True), linenum)
+        ids.update(new_ids)
+        for key in new_ids:
+            self.bloom.add(key)
+        entry.fingerprint = new_fingerprint
+        self.save()
+
+    # the names of the accounts and categories declared in the import tree
+    def account_names(self):
+        return [name for path in self.order for name in self.files[path].accounts]
+    def category_names(self):
+        return [name for path in self.order for name in self.files[path].categories]
+
+    # returns (path, line number) of the transaction of the account with the
+    # bank id, or None
+    def lookup(self, account, bank_id):
+        key = _key(account, bank_id)
+        if key not in self.bloom:
+            return None
+        for path in self.order:
+            linenum = self.ids()[path].get(key)
+            if linenum is not None:
+                return (path, linenum)
+        return None
+
+    def __contains__(self, key):
+        return self.lookup(*key) is not None
+
+
+# returns the BankIndex of the import tree of filename, brought up to date
+def load_bank_index(filename):
+    index = BankIndex(filename)
+    index.refresh()
+    return index
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Cost of date parsing within a parse (user-006).  Writes a synthetic ledger,
+# records the strings the parser hands to datetime_from_str, and reports the
+# time to convert them all against the time of the whole parse.  Run it once
+# more with BREADTRAIL_TREE naming a checkout from before the change for the
+# old share.
+#
+#   python benchmarks/bench_dates.py [--years N] [--per-year N] [--repeat N]
+import argparse
+import shutil
+import tempfile
+import time
+
+from genledger import write_ledger_tree, import_tree
+import_tree()
+
+from ledger import Ledger
+import parser
+import type_utils
+
+
+# best of several runs, in seconds; the cache of recent dates, where there
+# is one, starts out empty each time
+def best_time(f, repeat):
+    best = None
+    for _ in xrange(repeat):
+        getattr(type_utils, '_date_cache', {}).clear()
+        t = time.time()
+        f()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def convert_all(strs):
+    datetime_from_str = type_utils.datetime_from_str
+    for s in strs:
+        datetime_from_str(s)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Measure date parsing')
+    argparser.add_argument('--years', type=int, default=3)
+    argparser.add_argument('--per-year', dest='per_year', type=int, default=5000)
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        path = write_ledger_tree(dirname, args.years, args.per_year)
+
+        strs = []
+        def recording(s):
+            strs.append(s)
+            return type_utils.datetime_from_str(s)
+        parser.datetime_from_str = recording
+        parser.Parser(path, Ledger()).parse()
+        parser.datetime_from_str = type_utils.datetime_from_str
+
+        total = best_time(lambda: parser.Parser(path, Ledger()).parse(), args.repeat)
+    finally:
+        shutil.rmtree(dirname)
+
+    dates = best_time(lambda: convert_all(strs), args.repeat)
+    print "parse: %.2fs" % total
+    print "%d datetime_from_str calls: %.3fs (%.0f calls/s), %.1f%% of the parse" % (
+            len(strs), dates, len(strs)/dates, 100*dates/total)
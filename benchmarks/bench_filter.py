@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Throughput of the substitution rules (user-016).  Matches the descriptions
+# of every transaction in a ledger against the rules in use (the configured
+# rules file, or the built-in ones) through SubstitutionRules, and a sample
+# of them against a plain re.match of each rule in turn, which thrashes re's
+# pattern cache.  The ledger is a synthetic one unless one is named.
+#
+#   python benchmarks/bench_filter.py [--ledger FILE] [--per-year N]
+#
+# BREADTRAIL_TREE names another checkout to measure, for comparisons.
+import argparse
+import re
+import shutil
+import tempfile
+import time
+
+from genledger import write_ledger_tree, import_tree
+import_tree()
+
+from ledger import Ledger
+from parser import Parser
+from filter import current_rules
+
+
+def descriptions_of(path):
+    p = Parser(path, Ledger())
+    p.parse()
+    return [t.description for t in p.ledger.transactions]
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Measure the substitution rules')
+    argparser.add_argument('--ledger', default=None)
+    argparser.add_argument('--per-year', dest='per_year', type=int, default=5000)
+    args = argparser.parse_args()
+
+    if args.ledger:
+        descriptions = descriptions_of(args.ledger)
+    else:
+        dirname = tempfile.mkdtemp()
+        try:
+            descriptions = descriptions_of(write_ledger_tree(dirname, 3, args.per_year))
+        finally:
+            shutil.rmtree(dirname)
+
+    rules = current_rules()
+
+    def compiled(description):
+        return rules.matches(description)
+
+    def uncompiled(description):
+        found = []
+        for s in rules.rules:
+            match = re.match(s[0], description)
+            if match:
+                found.append((s, match))
+                description = match.expand(s[1])
+        return found
+
+    print "%d rules" % len(rules.rules)
+    for (name, fn, sample) in [('compiled', compiled, descriptions),
+                               ('re.match', uncompiled, descriptions[:500])]:
+        t0 = time.time()
+        matched = sum(1 for d in sample if fn(d))
+        elapsed = time.time() - t0
+        print "%-9s %d descriptions (%d matched) in %.3fs: %.0f descriptions/s" % \
+                (name + ':', len(sample), matched, elapsed, len(sample)/elapsed)
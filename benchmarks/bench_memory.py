@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Bytes per transaction of the parsed object model (user-008).  Parses a
+# synthetic ledger and reports the deep size of its transactions, including
+# their containers, allocations, properties and tags but not their lines,
+# with objects shared between transactions counted once; also the growth of
+# the process's peak RSS over the whole parse, lines included, and how many
+# transactions have each container created.
+#
+#   python benchmarks/bench_memory.py [--transactions N]
+#
+# BREADTRAIL_TREE names another checkout to measure, for comparisons.
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+from genledger import write_ledger_tree, import_tree
+import_tree()
+
+from ledger import Ledger, LedgerObject
+from parser import Parser
+
+
+# attributes that refer to objects outside the transaction
+_shared_attrs = ('line', 'parent_txn', 'account', 'category')
+
+def _attrs(o):
+    if hasattr(o, '__dict__'):
+        return o.__dict__.items()
+    names = [name for cls in type(o).__mro__ for name in getattr(cls, '__slots__', ())]
+    return [(name, getattr(o, name)) for name in names if hasattr(o, name)]
+
+def deep_size(objs):
+    seen = set()
+    total = 0
+    stack = list(objs)
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, LedgerObject):
+            if hasattr(o, '__dict__'):
+                total += sys.getsizeof(o.__dict__)
+            stack.extend(v for (k, v) in _attrs(o) if k not in _shared_attrs)
+    return total
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure bytes per parsed transaction')
+    parser.add_argument('--transactions', type=int, default=100000)
+    args = parser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        path = write_ledger_tree(dirname, 10, args.transactions//10)
+        r0 = rss()
+        p = Parser(path, Ledger())
+        p.parse()
+        r1 = rss()
+    finally:
+        shutil.rmtree(dirname)
+
+    txns = p.ledger.transactions
+    n = len(txns)
+    print "%d transactions" % n
+    print "object model: %.0f bytes/transaction" % (float(deep_size(txns))/n)
+    print "parse peak RSS growth: %.0f bytes/transaction" % (float(r1 - r0)/n)
+    for slot in ('_allocations', '_properties', '_tags', '_subcommands'):
+        if hasattr(txns[0], slot):
+            print "%s created: %d of %d" % (slot[1:], sum(getattr(t, slot) is not None for t in txns), n)
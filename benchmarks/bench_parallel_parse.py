@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Scaling of the parallel parse of an import tree (user-004).  Writes a
+# synthetic ledger with one imported file per year and reports:
+#   - the serial parse time;
+#   - per MB of ledger, what a worker spends parsing and pickling a file and
+#     what the main process spends unpickling and splicing it, which bound
+#     what any number of workers can gain;
+#   - the wall time of parse_fragments() plus the splice for several pool
+#     sizes, with the size and CPU gate (parser._pool_pays) bypassed.
+#
+#   python benchmarks/bench_parallel_parse.py [--years N] [--per-year N]
+#
+# BREADTRAIL_TREE names another checkout to measure, for comparisons.
+import argparse
+import cPickle as pickle
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from genledger import write_ledger_tree, import_tree
+import_tree()
+
+from ledger import Ledger
+import parser
+from parser import Parser, FragmentCache, parse_fragments
+
+
+def parse_serial(path):
+    p = Parser(path, Ledger(), FragmentCache())
+    p.parse()
+    return p
+
+def parse_pooled(path, processes):
+    fragments = parse_fragments(path, {}, processes)
+    p = Parser(path, Ledger(), FragmentCache(fragments))
+    p.parse()
+    return p
+
+def timed(f, *args):
+    t = time.time()
+    result = f(*args)
+    return (time.time() - t, result)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Measure the parallel parse')
+    argparser.add_argument('--years', type=int, default=12)
+    argparser.add_argument('--per-year', dest='per_year', type=int, default=5000)
+    argparser.add_argument('--jobs', type=int, nargs='*', default=[1, 2, 4, 8])
+    args = argparser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        path = write_ledger_tree(dirname, args.years, args.per_year)
+        files = sorted(glob.glob(os.path.join(dirname, 'y*.dat')))
+        mb = sum(os.path.getsize(f) for f in files)/float(1 << 20)
+        print "%d imported files, %.1f MB, %d CPUs" % (len(files), mb, multiprocessing.cpu_count())
+
+        (serial, expected) = timed(parse_serial, path)
+        print "serial parse: %.2fs (%.2fs/MB)" % (serial, serial/mb)
+
+        (worker, parent) = (0.0, 0.0)
+        fragments = {}
+        for f in files:
+            t = time.time()
+            data = parser._parse_fragment_pickled(f)
+            worker += time.time() - t
+            t = time.time()
+            fragments[f] = pickle.loads(data)
+            parent += time.time() - t
+        fragments[path] = parser._parse_fragment(path)
+        (splice, p) = timed(lambda: Parser(path, Ledger(), FragmentCache(fragments)).parse())
+        parent += splice
+        print "worker parse+pickle: %.2fs/MB; main unpickle+splice: %.2fs/MB" % (worker/mb, parent/mb)
+
+        parser._pool_pays = lambda paths, processes: True
+        for jobs in args.jobs:
+            (pooled, p) = timed(parse_pooled, path, jobs)
+            same = [c.line.raw_line for c in p.commands if getattr(c, 'line', None)] == \
+                    [c.line.raw_line for c in expected.commands if getattr(c, 'line', None)]
+            print "-j %d: %.2fs (%.2fx serial)%s" % (jobs, pooled, serial/pooled,
+                    "" if same else " DIFFERENT COMMANDS")
+    finally:
+        shutil.rmtree(dirname)
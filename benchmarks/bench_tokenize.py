@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Throughput of the line tokenizer (user-001).  Writes a synthetic ledger and
+# reports the lines per second Line() tokenizes, over the whole tree and over
+# just its indented subcommand lines.  Run it once more with BREADTRAIL_TREE
+# naming a checkout from before the change for the old figure.
+#
+#   python benchmarks/bench_tokenize.py [--years N] [--per-year N] [--repeat N]
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from genledger import write_ledger_tree, import_tree
+import_tree()
+
+from parser_tokenize import Line
+
+
+# best of several runs, in lines per second
+def lines_per_second(lines, repeat):
+    best = None
+    for _ in xrange(repeat):
+        t = time.time()
+        for rawline in lines:
+            Line(rawline).tokens
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return len(lines)/best
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Measure the tokenizer')
+    argparser.add_argument('--years', type=int, default=3)
+    argparser.add_argument('--per-year', dest='per_year', type=int, default=5000)
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        write_ledger_tree(dirname, args.years, args.per_year)
+        lines = []
+        for f in sorted(glob.glob(os.path.join(dirname, '*.dat'))):
+            with open(f) as fh:
+                lines.extend(fh.readlines())
+    finally:
+        shutil.rmtree(dirname)
+
+    subcommands = [l for l in lines if l[:1].isspace() and l.strip()]
+    print "%d lines: %.0f lines/s" % (len(lines), lines_per_second(lines, args.repeat))
+    print "%d subcommand lines: %.0f lines/s" % (len(subcommands),
+            lines_per_second(subcommands, args.repeat))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Writes a synthetic ledger for the benchmarks: a top-level file declaring
+# the accounts and categories and importing one file per year, each with
+# per_year transactions out of date order.  About half the transactions
+# allocate, some tag or carry a bank id, and the rest have no subcommands.
+import argparse
+import os
+import random
+import sys
+
+
+# makes the modules of the checkout importable, or of the one named by
+# $BREADTRAIL_TREE; it has to come before the standard library's parser
+def import_tree():
+    tree = os.environ.get('BREADTRAIL_TREE') or \
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, tree)
+
+
+_descriptions = ['23 BARTELL DRUGS  SEA', 'AUTOZONE #123', 'ST CLOUDS N/A', 'SAFEWAY',
+        'ATM WITHDRAWAL 1234', 'SYNAPSE PRODUCT DIRECT DEP', 'RANDOM "SHOP"', "o'reilly"]
+
+# writes the tree under dirname and returns the path of its top-level file
+def write_ledger_tree(dirname, years=3, per_year=200, seed=1):
+    rnd = random.Random(seed)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    path = os.path.join(dirname, 'ledger.dat')
+    with open(path, 'w') as root:
+        root.write('account chk "Checking Account"\naccount cc\n\n')
+        root.write('category "food:groceries"\n    goal $300\ncategory rent\ncategory "misc stuff"\n\n')
+        for y in range(2000, 2000 + years):
+            name = 'y%d.dat' % y
+            root.write('import %s\n' % name)
+            with open(os.path.join(dirname, name), 'w') as f:
+                f.write('# %d\n\n' % y)
+                for i in xrange(per_year):
+                    amount = rnd.randint(1, 50000)
+                    income = rnd.random() < 0.3
+                    desc = rnd.choice(_descriptions)
+                    q = "'" if '"' in desc else '"'
+                    f.write('%04d-%02d-%02d $%d.%02d %s %s %s%s%s\n' % (y, rnd.randint(1, 12),
+                            rnd.randint(1, 28), amount//100, amount % 100,
+                            'into' if income else 'from', rnd.choice(['chk', 'cc']), q, desc, q))
+                    (verb, prep) = ('put', 'into') if income else ('take', 'from')
+                    if rnd.random() < 0.4:
+                        f.write('    %s $%d.%02d %s "food:groceries"\n' % (verb, amount//200,
+                                amount % 100, prep))
+                    if rnd.random() < 0.2:
+                        f.write('    %s all %s rent\n' % (verb, prep))
+                    if rnd.random() < 0.1:
+                        f.write('    tag foo\n')
+                    if rnd.random() < 0.2:
+                        f.write('    bank_id: "%d%06d"\n' % (y, i))
+                    f.write('\n')
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic ledger')
+    parser.add_argument('dirname')
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--per-year', dest='per_year', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print write_ledger_tree(args.dirname, args.years, args.per_year, args.seed)
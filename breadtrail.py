@@ -3,13 +3,14 @@
 from ledger import *
 from type_utils import *
 import parser
+import parser_cache
+import ledger_columns
 from config import config
-from filter import filter_transaction
+from filter import filter_transaction, current_memo, save_memo, prefill_memo
 
 import cmdln
 import sys, os
 import re
-import filecmp
 import readline
 
 
@@ -20,56 +21,83 @@ class BreadTrail(cmdln.Cmdln):
     def __init__(self):
         cmdln.Cmdln.__init__(self)
 
+    def _parse_error(self, e):
+        sys.stderr.write("Error (%s:%d): %s" % (e.filename, e.linenum, e.msg))
+        if not e.msg.endswith('\n'):
+            sys.stderr.write('\n')
+        sys.exit(1)
+
     def _parse_ledger(self):
         try:
-            self.parser = parser.Parser(self.options.filename or config.get_ledger_path())
-            self.parser.parse()
+            self.parser = parser_cache.parse_cached(self.options.filename or config.get_ledger_path(),
+                    self.options.parse_jobs)
+        except parser.ParseError as e:
+            self._parse_error(e)
+
+    # streams the transactions of the ledger for read-only commands; once the
+    # iteration is done, self.ledger holds all the accounts and categories
+    def _iter_transactions(self):
+        p = parser.Parser(self.options.filename or config.get_ledger_path(), Ledger())
+        self.ledger = p.ledger
+        try:
+            for t in p.iter_transactions():
+                yield t
         except parser.ParseError as e:
-            sys.stderr.write("Error (%s:%d): %s" % (e.filename, e.linenum, e.msg))
-            if not e.msg.endswith('\n'):
-                sys.stderr.write('\n')
-            sys.exit(1)
+            self._parse_error(e)
 
+    # returns the parsed ledger when its snapshot is current, so that no file
+    # has to be parsed, or None
+    def _snapshot_ledger(self):
+        try:
+            p = parser_cache.parse_snapshot(self.options.filename or config.get_ledger_path())
+        except parser.ParseError as e:
+            self._parse_error(e)
+        return p.ledger if p else None
+
+    # Balances for the read-only balance commands, as (ledger, balances by
+    # name), as of date (None for all time).  When the snapshot is current the
+    # balances come from its parsed ledger: as of a date from the date index,
+    # which starts from the snapshotted checkpoints, and for all time from the
+    # columnar view when numpy is available, or else the date index too.
+    # Otherwise the ledger is streamed, in flat memory.
+    def _account_balances(self, date):
+        L = self._snapshot_ledger()
+        if L is not None:
+            if date is None and ledger_columns.numpy is not None:
+                return (L, L.columns().account_balances())
+            return (L, L.date_index().account_balances(date))
+        balances = {}
+        for t in self._iter_transactions():
+            if date is None or t.date <= date:
+                balances[t.account.name] = balances.get(t.account.name, Amount(0)) + t.signed_amount()
+        return (self.ledger, balances)
+
+    def _envelope_balances(self, date):
+        L = self._snapshot_ledger()
+        if L is not None:
+            if date is None and ledger_columns.numpy is not None:
+                return (L, L.columns().envelope_balances())
+            return (L, L.date_index().envelope_balances(date))
+        balances = { '<unallocated>': Amount(0) }
+        for t in self._iter_transactions():
+            if date is not None and t.date > date:
+                continue
+            for a in t.allocations.itervalues():
+                balances[a.category.name] = balances.get(a.category.name, Amount(0)) + a.amount*t.sign
+            balances['<unallocated>'] += t.unallocated_amount()
+        return (self.ledger, balances)
+
+    # writes each file with changed lines to '<name>_' for 'commit'
     def _write_ledger(self):
-        class writer(object):
-            def __init__(self, filename):
-                self.filename = filename
-                self.fp = open(self.filename + '_', 'w')
-            def write(self, s):
-                self.fp.write(s)
-            def finish_and_test_same(self):
-                self.fp.close()
-                if not filecmp.cmp(self.filename, self.filename + '_'):
-                    return False
-                os.remove(self.filename + '_')
-                return True
-
-        out_stack = [writer(self.parser.filename)]
-        #print ">>> output is now going to " + out_stack[-1].filename
-        for cmd in self.parser.commands:
-            if cmd.line:
-                out_stack[-1].write(cmd.line.raw_line)
-            if hasattr(cmd, 'subcommands'):
-                for scmd in cmd.subcommands:
-                    if scmd.line:
-                        out_stack[-1].write(scmd.line.raw_line)
-            if isinstance(cmd, ImportFile):
-                out_stack.append(writer(cmd.path))
-                #print ">>> output is now going to " + out_stack[-1].filename
-            elif isinstance(cmd, EndOfFile):
-                last_writer = out_stack.pop()
-                if last_writer.finish_and_test_same():
-                    pass
-                #    print ">>> no difference when writing %s; deleting tmp file" % last_writer.filename
-                if len(out_stack) > 0: # still going
-                    pass
-                #    print ">>> output is back to " + out_stack[-1].filename
+        parser.write_ledger(self.parser)
 
 
     def get_optparser(self):
         op = cmdln.Cmdln.get_optparser(self)
         op.add_option("-f", "--filename", dest="filename",
                       help="ledger filename")
+        op.add_option("--parse-jobs", dest="parse_jobs", type="int", default=None,
+                      help="parse imported files in this many processes, if the ledger is big enough")
         return op
 
 
@@ -104,6 +132,9 @@ class BreadTrail(cmdln.Cmdln):
                         sys.stderro.write("Error commiting '%s': %s\n" % (new_path, str(e)))
 
 
+    @cmdln.option("--stats", action="store_true", help="report the filter memo hit rate")
+    @cmdln.option("--match-jobs", dest="match_jobs", type="int", default=None,
+                  help="match descriptions against the rules in this many processes")
     def do_filter(self, subcmd, opts):
         """${cmd_name}: filter the register
 
@@ -111,10 +142,16 @@ class BreadTrail(cmdln.Cmdln):
         ${cmd_option_list}
         """
         self._parse_ledger()
+        if opts.match_jobs > 1:
+            prefill_memo([t.description for t in self.parser.ledger.transactions],
+                    opts.match_jobs)
         for t in self.parser.ledger.transactions:
             if filter_transaction(self.parser.ledger, t):
                 self.parser.update_transaction(t)
         self._write_ledger()
+        save_memo()
+        if opts.stats:
+            print current_memo().stats()
 
     def expand_account_names_list(self, names):
         names_list = []
@@ -133,16 +170,12 @@ class BreadTrail(cmdln.Cmdln):
         ${cmd_usage}
         ${cmd_option_list}
         """
-        self._parse_ledger()
-        L = self.parser.ledger
-
         date = datetime_from_str(opts.date) if opts.date else None
+        (L, balances) = self._account_balances(date)
 
         keys = L.accounts.keys()
-        balances = dict(zip(keys, [Amount(0)]*len(keys)))
-        for t in L.transactions:
-            if date and t.date > date: continue
-            balances[t.account.name] += t.signed_amount()
+        for name in keys:
+            balances.setdefault(name, Amount(0))
 
         if len(names) == 0:
             names_list = keys
@@ -168,21 +201,12 @@ class BreadTrail(cmdln.Cmdln):
         ${cmd_usage}
         ${cmd_option_list}
         """
-        self._parse_ledger()
-        L = self.parser.ledger
-
         date = datetime_from_str(opts.date) if opts.date else None
+        (L, balances) = self._envelope_balances(date)
 
         keys = sorted(L.categories.keys()) + ['<unallocated>']
-        balances = dict(zip(keys, [Amount(0)]*len(keys)))
-        for t in L.transactions:
-            if date and t.date > date: continue
-            print t, t.allocations
-            for (cat_name, a) in t.allocations.iteritems():
-                amount = a.amount
-                print '  %s->%s' % (str(a.amount), cat_name)
-                balances[a.category.name] += amount*t.sign
-            balances['<unallocated>'] += t.unallocated_amount()
+        for name in keys:
+            balances.setdefault(name, Amount(0))
 
         if len(names) == 0:
             names_list = keys
@@ -234,8 +258,7 @@ class BreadTrail(cmdln.Cmdln):
             select = compile('lambda %s: %s' % (t_var_name, opts.select_expn), '<string>', 'eval')
 
         balance = Amount(0)
-        for t in self.parser.ledger.transactions:
-            if t.account is not account: continue
+        for t in self.parser.ledger.account_transactions(account.name):
             amount = t.signed_amount()
             balance = balance + amount
             if select and not eval(select)(t):
@@ -282,9 +305,7 @@ class BreadTrail(cmdln.Cmdln):
             select = compile(opts.select_expn, '<string>', 'eval')
 
         balance = Amount(0)
-        for t in self.parser.ledger.transactions:
-            if not cat.name in t.allocations:
-                continue
+        for t in self.parser.ledger.category_transactions(cat.name):
             a = t.allocations[cat.name]
             amount = a.amount
             balance = balance + amount
@@ -303,8 +324,6 @@ class BreadTrail(cmdln.Cmdln):
         ${cmd_usage}
         ${cmd_option_list}
         """
-        self._parse_ledger()
-
         if not opts.select_expn:
             select = None
         else:
@@ -328,7 +347,7 @@ class BreadTrail(cmdln.Cmdln):
         context = { }
         if init:
             exec(init, context)
-        for t in self.parser.ledger.transactions:
+        for t in self._iter_transactions():
             if select != None and not eval(select, context)(t):
                 continue
             context[t_var_name] = t
@@ -8,6 +8,15 @@ _defaults = {
         'ledger': {
             'path': os.path.join(_ledger_config_dir, 'ledger.dat'),
         },
+        'filter': {
+            'rules': os.path.join(_ledger_config_dir, 'rules'),
+            'keep_memo': 'no',
+        },
+        'import': {
+            'reconcile_window': '3',
+            'statement_cache': os.path.join(_ledger_config_dir, 'statements'),
+            'statement_cache_mb': '64',
+        },
 }
 
 class BreadTrailConfig(configparser.ConfigParser):
@@ -22,6 +31,22 @@ class BreadTrailConfig(configparser.ConfigParser):
             path = os.path.join(_ledger_config_dir, path)
         return path
 
+    # the merchant rules file for filter.filter_subs
+    def get_rules_path(self):
+        path = os.path.expanduser(config.get('filter', 'rules'))
+        if not os.path.isabs(path):
+            path = os.path.join(_ledger_config_dir, path)
+        return path
+
+    # the directory of ofxstream.StatementCache, or None for no cache
+    def get_statement_cache_path(self):
+        path = os.path.expanduser(config.get('import', 'statement_cache'))
+        if not path:
+            return None
+        if not os.path.isabs(path):
+            path = os.path.join(_ledger_config_dir, path)
+        return path
+
 
 config = BreadTrailConfig()
 
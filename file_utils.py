@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+
+# the cache file for 'dir/name' lives in 'dir/.name.cache'
+def snapshot_path(filename):
+    (dirname, basename) = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.cache')
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(1 << 16)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# returns (size, mtime, sha1) for a file
+def file_fingerprint(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, _file_sha1(path))
+
+# True if the file still has the given fingerprint.  The content hash is only
+# computed when the size and mtime already match, and with recorded, the time
+# the fingerprint was recorded at, not even then if the file is older than
+# that by more than the coarsest mtime resolution (FAT's two seconds): only
+# an edit within the same tick as the last one can keep both the size and
+# the mtime.
+def fingerprint_matches(path, fingerprint, recorded=None):
+    try:
+        st = os.stat(path)
+        if (st.st_size, st.st_mtime) != fingerprint[0:2]:
+            return False
+        if recorded is not None and st.st_mtime < recorded - 2:
+            return True
+        return _file_sha1(path) == fingerprint[2]
+    except (IOError, OSError):
+        return False
@@ -1,7 +1,17 @@
 from ledger import *
 from type_utils import *
+from config import config
+from file_utils import snapshot_path, file_fingerprint, fingerprint_matches
+from parser_tokenize import Line, LineParseError
 
+import cPickle as pickle
+import bisect
+import hashlib
+import multiprocessing
+import os
 import re
+import sys
+import time
 
 
 
@@ -189,18 +199,394 @@ _subs = [
         ("ATM CHECK DEPOSIT.*1429 BRO", "Deposit at Chase ATM, 1429 Broadway", None),
         ("ATM CHECK DEPOSIT.*600 PINE", "Deposit at Chase ATM, 600 Pine St.", None),
         ]
+# inline flags apply to the whole pattern wherever they are, and (?i) or (?x)
+# change what its literal text matches
+_inline_flags_re = re.compile(r'\(\?[iLmsux]')
+
+# returns (prefix, whole) where prefix is the literal text that every string
+# matched by pattern (from the start, as re.match does) has to begin with, ''
+# when there is none, and whole is true if the pattern is nothing but that text
+def _literal_prefix(pattern):
+    if '|' in pattern or _inline_flags_re.search(pattern):
+        return ('', False)
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i+1].isalnum():
+            c = pattern[i+1]
+            i += 2
+        elif c == '\\' or c in '.^$*+?{}[]()':
+            return (''.join(prefix), False)
+        else:
+            i += 1
+        # a quantifier makes the character before it optional
+        if i < len(pattern) and pattern[i] in '*?{':
+            return (''.join(prefix), False)
+        prefix.append(c)
+    return (''.join(prefix), True)
+
+def literal_prefix(pattern):
+    return _literal_prefix(pattern)[0]
+
+
+# The substitution rules, with the rules that could match a description found
+# through the first character of their literal prefix.  Each pattern is only
+# compiled the first time a description gets as far as trying it, so a rule
+# set unpickled from the rules cache costs nothing per rule until it is used.
+# matches() has the semantics of trying every rule in order with re.match
+# against the current description: each match rewrites the description and
+# later rules see the rewritten one.
+class SubstitutionRules(object):
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.matchers = [None]*len(self.rules)
+        self.prefixes = [literal_prefix(r[0]) for r in self.rules]
+
+        # rule indices by the first character of their prefix, each list
+        # merged with the rules that have no prefix
+        unprefixed = [i for (i, p) in enumerate(self.prefixes) if not p]
+        by_char = {}
+        for (i, p) in enumerate(self.prefixes):
+            if p:
+                by_char.setdefault(p[0], []).append(i)
+        self.unprefixed = unprefixed
+        self.by_char = dict((c, sorted(l + unprefixed)) for (c, l) in by_char.iteritems())
+
+        # identifies the rule set, for FilterMemo
+        self.signature = hashlib.sha1(repr(self.rules)).hexdigest()
+
+    # compiled patterns don't pickle; they are recompiled on demand
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['matchers'] = [None]*len(self.rules)
+        return state
+
+    def _candidates(self, description):
+        return self.by_char.get(description[:1], self.unprefixed)
+
+    def _match(self, i, description):
+        matcher = self.matchers[i]
+        if matcher is None:
+            matcher = self.matchers[i] = re.compile(self.rules[i][0]).match
+        return matcher(description)
+
+    # returns the (rule, match) pairs for a description, in rule order, with
+    # each match made against the description as rewritten by the previous
+    # ones
+    def matches(self, description):
+        found = []
+        candidates = self._candidates(description)
+        k = 0
+        while k < len(candidates):
+            i = candidates[k]
+            k += 1
+            if not description.startswith(self.prefixes[i]):
+                continue
+            match = self._match(i, description)
+            if match:
+                rule = self.rules[i]
+                found.append((rule, match))
+                description = match.expand(rule[1])
+                candidates = self._candidates(description)
+                k = bisect.bisect_right(candidates, i)
+        return found
+
+
+def _rules_warning(path, linenum, msg):
+    sys.stderr.write("Warning (%s:%d): %s\n" % (path, linenum, msg))
+
+# splits a rules line into (pattern, rest of the line).  The pattern is taken
+# raw: up to the first whitespace, or between quotes when it starts with one.
+def _split_pattern(line):
+    line = line.lstrip()
+    if line[:1] in ('"', "'"):
+        end = line.find(line[0], 1)
+        if end < 0:
+            raise LineParseError(len(line), "unclosed quote")
+        return (line[1:end], line[end+1:])
+    fields = line.split(None, 1)
+    return (fields[0], fields[1] if len(fields) > 1 else '')
+
+# Reads a rules file, one rule per line:
+#
+#   PATTERN DESCRIPTION [CATEGORY]
+#
+# The pattern is read raw, backslashes, quotes and '#' included, and only
+# needs quotes when it has spaces in it; the rest of the line is split like a
+# ledger line.  Lines starting with '#' are comments.  E.g.
+#
+#   SEATTLE\s+684-PARK.*  "Seattle DOT Street Parking"  parking
+#   "QFC #5847"  "QFC--Broadway and Pine, Seattle, WA"  food:groceries
+#
+# Returns the rules as (pattern, description, category) tuples.  Malformed
+# rules are skipped, and they, duplicated patterns, and rules that can never
+# see a description because an earlier rule of the form 'LITERAL.*' rewrites
+# everything they could match are reported on stderr.
+def read_rules(path):
+    rules = []
+    first_line  = {}   # pattern -> line of its first rule
+    prefix_rules = {}  # literal -> line of the first 'LITERAL.*' rule
+    with open(path) as fp:
+        for (linenum, raw_line) in enumerate(fp, 1):
+            if not raw_line.strip() or raw_line.lstrip().startswith('#'):
+                continue
+            try:
+                (pattern, rest) = _split_pattern(raw_line)
+                tokens = [pattern] + Line(rest).token_values()
+            except LineParseError as e:
+                _rules_warning(path, linenum, str(e))
+                continue
+            if len(tokens) not in (2, 3):
+                _rules_warning(path, linenum, "wrong number of arguments (%d)" % len(tokens))
+                continue
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                _rules_warning(path, linenum, "invalid pattern '%s': %s" % (pattern, e))
+                continue
+
+            if pattern in first_line:
+                _rules_warning(path, linenum, "duplicate of the rule on line %d" % first_line[pattern])
+            else:
+                first_line[pattern] = linenum
+                prefix = literal_prefix(pattern)
+                shadows = [prefix_rules[prefix[:n]] for n in xrange(len(prefix) + 1)
+                        if prefix[:n] in prefix_rules]
+                if shadows:
+                    _rules_warning(path, linenum, "shadowed by the rule on line %d" % shadows[0])
+                if pattern.endswith('.*'):
+                    (literal, whole) = _literal_prefix(pattern[:-2])
+                    if whole:
+                        prefix_rules.setdefault(literal, linenum)
+
+            rules.append((pattern, tokens[1], tokens[2] if len(tokens) == 3 else None))
+    return rules
+
+
+# bump whenever SubstitutionRules changes shape
+_rules_cache_version = 2
+
+# returns the SubstitutionRules of a rules file, from the cache next to it
+# ('dir/.rules.cache') unless the file changed since it was written.  A rules
+# file older than its cache is only checked by size and mtime, not rehashed.
+def load_rules(path):
+    cache_path = snapshot_path(path)
+    try:
+        with open(cache_path, 'rb') as fp:
+            written = os.fstat(fp.fileno()).st_mtime
+            (version, cached_path, fingerprint, rules) = pickle.load(fp)
+        if version == _rules_cache_version and cached_path == path and \
+                fingerprint_matches(path, fingerprint, written):
+            return rules
+    except Exception:
+        pass
+
+    fingerprint = file_fingerprint(path)
+    rules = SubstitutionRules(read_rules(path))
+    tmp_path = cache_path + '_'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump((_rules_cache_version, path, fingerprint, rules), fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError, pickle.PicklingError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rules
+
+
+# The rules in use: those of the configured rules file, or the built-in _subs
+# when there is none.  The file is checked for changes at most once a second,
+# so edits are picked up by long-running commands too.
+_sub_rules = None
+_sub_rules_stat = None
+_sub_rules_checked = 0
+
+def current_rules():
+    global _sub_rules, _sub_rules_stat, _sub_rules_checked
+    now = time.time()
+    if _sub_rules is not None and now - _sub_rules_checked < 1:
+        return _sub_rules
+    _sub_rules_checked = now
+    path = config.get_rules_path()
+    try:
+        st = os.stat(path)
+        stat = (path, st.st_size, st.st_mtime)
+    except OSError:
+        stat = None
+    if _sub_rules is None or stat != _sub_rules_stat:
+        _sub_rules = load_rules(path) if stat else SubstitutionRules(_subs)
+        _sub_rules_stat = stat
+    return _sub_rules
+
+
+# Remembers, per raw description, what filter_subs and filter_titlecase do
+# with it, since bank descriptions repeat constantly.  A memo belongs to one
+# rule set (by signature) and is replaced when the rules change.  With
+# '[filter] keep_memo = yes' in the config, it is saved next to the rules
+# file between runs.
+class FilterMemo(object):
+    max_size = 1 << 16   # entries per table; a full table is emptied
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.subs   = {}   # description -> (bank description, description, category) or None
+        self.titles = {}   # description -> titlecased description
+        self.lookups = 0
+        self.hits    = 0
+
+    def _lookup(self, table, description, fn):
+        self.lookups += 1
+        if description in table:
+            self.hits += 1
+            return table[description]
+        if len(table) >= self.max_size:
+            table.clear()
+        result = table[description] = fn(description)
+        return result
+
+    def subs_result(self, rules, description):
+        return self._lookup(self.subs, description, lambda d: _apply_subs(rules, d))
+
+    def titlecase(self, description):
+        return self._lookup(self.titles, description, titlecase)
+
+    # stores results computed elsewhere (see prefill_memo()); title is None
+    # when it wasn't computed
+    def put(self, description, subs, title):
+        if len(self.subs) < self.max_size:
+            self.subs[description] = subs
+        if title is not None and len(self.titles) < self.max_size:
+            self.titles[description] = title
+
+    # adds the entries a copy of the memo made in another process
+    def merge(self, subs, titles):
+        for (table, entries) in ((self.subs, subs), (self.titles, titles)):
+            for (description, result) in entries.iteritems():
+                if len(table) < self.max_size:
+                    table[description] = result
+
+    # returns a summary of the hit rate
+    def stats(self):
+        rate = 100.0*self.hits/self.lookups if self.lookups else 0.0
+        return "filter memo: %d lookups, %d hits (%.1f%%)" % (self.lookups, self.hits, rate)
+
+    def __getstate__(self):
+        return (self.signature, self.subs, self.titles)
+    def __setstate__(self, state):
+        (self.signature, self.subs, self.titles) = state
+        self.lookups = 0
+        self.hits    = 0
+
+
+def _memo_path():
+    return os.path.join(os.path.dirname(config.get_rules_path()), '.filter.memo')
+
+def _keep_memo():
+    return config.getboolean('filter', 'keep_memo')
+
+_memo = None
+
+# returns the FilterMemo for the rules in use
+def current_memo():
+    global _memo
+    rules = current_rules()
+    if _memo is not None and _memo.signature == rules.signature:
+        return _memo
+    memo = None
+    if _memo is None and _keep_memo():
+        try:
+            with open(_memo_path(), 'rb') as fp:
+                memo = pickle.load(fp)
+        except Exception:
+            pass
+    if not isinstance(memo, FilterMemo) or memo.signature != rules.signature:
+        memo = FilterMemo(rules.signature)
+    if _memo is not None:
+        (memo.lookups, memo.hits) = (_memo.lookups, _memo.hits)
+    _memo = memo
+    return _memo
+
+# saves the memo for the next run, if configured to; failures are not fatal
+# since it is only ever an optimization
+def save_memo():
+    if _memo is None or not _keep_memo():
+        return
+    path = _memo_path()
+    tmp_path = path + '_'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(_memo, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, pickle.PicklingError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# returns what the substitution rules do to a description, as
+# (bank description, description, category), or None if no rule matches
+def _apply_subs(rules, description):
+    found = rules.matches(description)
+    if not found:
+        return None
+    category = None
+    for (s, match) in found:
+        bank_description = description
+        description = match.expand(s[1])
+        if len(s) > 2 and s[2] is not None:
+            category = s[2]
+    return (bank_description, description, category)
+
+
+# worker for prefill_memo(): returns (description, subs result, titlecased
+# description or None) for a chunk of descriptions.  The titlecased text is
+# only needed when no rule matches.  Descriptions that raise are left out,
+# so filtering them in the main process reports the error as usual.
+def _memo_entries(descriptions):
+    rules = current_rules()
+    entries = []
+    for description in descriptions:
+        try:
+            subs = _apply_subs(rules, description)
+            entries.append((description, subs, titlecase(description) if subs is None else None))
+        except Exception:
+            pass
+    return entries
+
+# Matches the distinct descriptions not yet in the memo against the rules in
+# a pool of worker processes and stores the results, so that filtering the
+# transactions afterwards, in order in this process, only applies them.
+def prefill_memo(descriptions, processes):
+    memo = current_memo()
+    todo = list(set(d for d in descriptions if d not in memo.subs))[:FilterMemo.max_size]
+    if not todo:
+        return
+    size = max(64, len(todo) // (processes*4) + 1)
+    chunks = [todo[i:i+size] for i in xrange(0, len(todo), size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for entries in pool.imap_unordered(_memo_entries, chunks):
+            for (description, subs, title) in entries:
+                memo.put(description, subs, title)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 @add_filter
 def filter_subs(ledger, t):
-    filtered = False
-    for s in _subs:
-        match = re.match(s[0], t.description)
-        if match:
-            t.properties['bank_description'] = Property('bank_description', t.description)
-            t.description = match.expand(s[1])
-            if len(s) > 2 and s[2] is not None:
-                t.allocations = { s[2]: Allocation(t, t.amount, ledger.categories[s[2]]) }
-            filtered = True
-    return filtered
+    result = current_memo().subs_result(current_rules(), t.description)
+    if result is None:
+        return False
+    (bank_description, description, category) = result
+    t.properties['bank_description'] = Property('bank_description', bank_description)
+    t.description = description
+    if category is not None:
+        t.allocations = { category: Allocation(t, t.amount, ledger.categories[category]) }
+    return True
 
 
 @add_filter
@@ -208,7 +594,7 @@ def filter_titlecase(ledger, t):
     if 'bank_description' in t.properties: return False
     if 'bank_memo'        in t.properties: return False
     t.properties['bank_description'] = Property('bank_description', t.description)
-    t.description = titlecase(t.description)
+    t.description = current_memo().titlecase(t.description)
     return True
 
 
@@ -1,53 +1,72 @@
-from type_utils import cents_from_str
+from type_utils import cents_from_str, month_key
 from sys import maxint
+import bisect
 
 
+# Amounts are immutable values holding a whole number of cents.  Arithmetic
+# builds results straight from cents through _amount(), which also hands out
+# shared instances for small values.
 class Amount(object):
+    __slots__ = ('cents',)
+
     def __init__(self, amount, cents=None):
         if isinstance(amount, int):
-            self.cents = amount*100
+            c = amount*100
         elif isinstance(amount, float):
-            self.cents = int(amount*100.0)
+            c = int(amount*100.0)
         elif isinstance(amount, str):
-            self.cents = cents_from_str(amount)
+            c = cents_from_str(amount)
         elif isinstance(amount, Amount):
-            self.cents = amount.cents
+            c = amount.cents
         else:
             raise ValueError("invalid literal for Amount(): '%s'" % repr(amount))
         if cents != None:
-            self.cents += int(cents)
+            c += int(cents)
+        _set_cents(self, c)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Amount is immutable")
+    def __delattr__(self, name):
+        raise AttributeError("Amount is immutable")
+    def __reduce__(self):
+        return (_amount, (self.cents,))
 
     @staticmethod
     def from_cents(c):
-        return Amount(c//100, c % 100)
+        return _amount(c)
+
+    # like Amount(s) for a string, without the type dispatch
+    @staticmethod
+    def from_str(s):
+        return _amount(cents_from_str(s))
 
     def __float__(self):
         return float(self.cents)/100.0
 
     def __add__(self, other):
-        return Amount(0, self.cents + other.cents)
+        return _amount(self.cents + other.cents)
 
     def __sub__(self, other):
-        return Amount(0, self.cents - other.cents)
+        return _amount(self.cents - other.cents)
 
     def __mul__(self, other):
         if isinstance(other, int):
-            return Amount(0, self.cents*other)
+            return _amount(self.cents*other)
         elif isinstance(other, float):
-            return Amount(0, int(self.cents*other))
+            return _amount(int(self.cents*other))
         else:
-            return Amount(0, self.cents*other.cents)
+            return _amount(self.cents*other.cents)
 
     def __div__(self, other):
         if isinstance(other, int):
-            return Amount(0, self.cents/other)
+            return _amount(self.cents/other)
         elif isinstance(other, float):
-            return Amount(0, int(self.cents/other))
+            return _amount(int(self.cents/other))
         else:
-            return Amount(0, self.cents/other.cents)
+            return _amount(self.cents/other.cents)
 
     def __neg__(self):
-        return Amount(0, -self.cents)
+        return _amount(-self.cents)
 
     def __eq__(self, other):
         if isinstance(other, Amount):
@@ -55,9 +74,16 @@ class Amount(object):
         elif isinstance(other, int):
             return self.cents == other*100
         elif isinstance(other, float):
-            return self.cents == int(other*100.0)
+            return float(self) == other
         else:
             return False
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        # amounts compare equal to the numbers of dollars they hold, so they
+        # hash like them
+        c = self.cents
+        return hash(c//100) if c % 100 == 0 else hash(c/100.0)
     def __gt__(self, other):
         return self.cents >  other.cents if isinstance(other, Amount) else self.cents >  other*100
     def __ge__(self, other):
@@ -86,30 +112,144 @@ class Amount(object):
     def __repr__(self):
         return 'Amount ' + self.format()
 
+_set_cents = Amount.cents.__set__
+
+def _new_amount(c):
+    a = object.__new__(Amount)
+    _set_cents(a, c)
+    return a
+
+# -$10.24 to $102.39 are shared rather than allocated on every operation
+_small_min = -1024
+_small_max = 10240
+_small_amounts = tuple(_new_amount(c) for c in xrange(_small_min, _small_max))
+
+def _amount(c):
+    if _small_min <= c < _small_max:
+        return _small_amounts[c - _small_min]
+    return _new_amount(c)
+
 def mk_amount(a):
     return a if isinstance(a, Amount) else Amount(a)
 
 def amount_from_str_or_none(s):
-    try:               return Amount(a)
+    try:               return Amount(s)
     except ValueError: return None
 
 
+# account, category, tag and property key names repeat across the whole
+# ledger, so only one copy of each is kept
+def _intern(s):
+    return intern(s) if type(s) is str else s
+
+
+# A container attribute kept in a slot that stays None until something is
+# first written to it, so objects that never get one hold no empty container.
+# Until then the attribute reads as a _LazyView; setting it to None empties
+# it again.
+class _LazyContainer(object):
+    def __init__(self, slot, factory):
+        self.slot = slot
+        self.factory = factory
+        self.empty = factory()   # what every unwritten attribute reads as
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        c = getattr(obj, self.slot)
+        if c is None:
+            return _LazyView(obj, self)
+        return c
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+    # the object's container, creating it if needed
+    def create(self, obj):
+        c = getattr(obj, self.slot)
+        if c is None:
+            c = self.factory()
+            setattr(obj, self.slot, c)
+        return c
+
+# methods of dict, list and set that change the container
+_container_writers = frozenset(['add', 'append', 'clear', 'difference_update', 'discard',
+        'extend', 'insert', 'intersection_update', 'pop', 'popitem', 'remove', 'reverse',
+        'setdefault', 'sort', 'symmetric_difference_update', 'update'])
+
+# An unwritten _LazyContainer attribute of an object: reads go to the empty
+# container shared by all of them, and the first write creates the object's
+# own container.  Once it exists the view reads and writes that one.
+class _LazyView(object):
+    __slots__ = ('_obj', '_lazy')
+
+    def __init__(self, obj, lazy):
+        self._obj = obj
+        self._lazy = lazy
+
+    def _read(self):
+        c = getattr(self._obj, self._lazy.slot)
+        return self._lazy.empty if c is None else c
+    def _write(self):
+        return self._lazy.create(self._obj)
+
+    def __getattr__(self, name):
+        if name in _container_writers:
+            return getattr(self._write(), name)
+        return getattr(self._read(), name)
+
+    def __len__(self):           return len(self._read())
+    def __iter__(self):          return iter(self._read())
+    def __contains__(self, x):   return x in self._read()
+    def __getitem__(self, k):    return self._read()[k]
+    def __setitem__(self, k, v): self._write()[k] = v
+    def __delitem__(self, k):    del self._write()[k]
+    def __getslice__(self, i, j):     return self._read()[i:j]
+    def __setslice__(self, i, j, v):  self._write()[i:j] = v
+    def __delslice__(self, i, j):     del self._write()[i:j]
+    def __nonzero__(self):       return bool(self._read())
+    def __repr__(self):          return repr(self._read())
+
+    def __eq__(self, other):
+        if isinstance(other, _LazyView):
+            other = other._read()
+        return self._read() == other
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None
+
+
 class LedgerObject(object):
+    __slots__ = ()
+
+    # attribute values for comparison; unused lazy containers compare the
+    # same as empty ones
+    def _state(self):
+        if hasattr(self, '__dict__'):
+            return self.__dict__
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    value = getattr(self, name)
+                    if isinstance(getattr(cls, name.lstrip('_'), None), _LazyContainer):
+                        value = value or None
+                    state[name] = value
+        return state
+
     def __eq__(self, other):
-        return isinstance(other, LedgerObject) and self.__dict__ == other.__dict__
+        return isinstance(other, LedgerObject) and self._state() == other._state()
     def __ne__(self, other):
         return not self == other
 
 
 class Account(LedgerObject):
     def __init__(self, name, description=None):
-        self.name = name
+        self.name = _intern(name)
         self.description = description
 
 
 class Category(LedgerObject):
     def __init__(self, name, description=None):
-        self.name = name
+        self.name = _intern(name)
         self.description = description
         self.goal = None
 
@@ -119,6 +259,15 @@ class CategoryGoal(LedgerObject):
 
 
 class Transaction(LedgerObject):
+    __slots__ = ('sign', 'amount', 'date', 'account', 'description',
+            '_allocations', 'remainder_allocation', 'projected', '_properties', '_tags',
+            '_subcommands', 'line')
+
+    allocations = _LazyContainer('_allocations', dict)  # map of category names to Allocations
+    properties  = _LazyContainer('_properties', dict)   # map of key names to Properties
+    tags        = _LazyContainer('_tags', set)
+    subcommands = _LazyContainer('_subcommands', list)
+
     def __init__(self, amount, date, account):
         amount = mk_amount(amount)
         if amount < 0:
@@ -130,23 +279,33 @@ class Transaction(LedgerObject):
         self.date = date
         self.account = account
         self.description = None;
-        self.allocations = {}  # map of category names to Allocations
+        self._allocations = None
         self.remainder_allocation = None
         self.projected = False
-        self.properties = {}   # map of key names to Properties
-        self.tags = set()
+        self._properties = None
+        self._tags = None
+        self._subcommands = None
 
     def __repr__(self):
         fmt = "%s %s " + ("from" if self.sign == -1 else "into") + " %s: %s"
         return fmt % (self.date, self.amount, self.account.name, self.description)
 
     def __hash__(self):
-        if 'bank_description' in self.properties:
-            desc = self.properties['bank_description'].value
+        if self._properties and 'bank_description' in self._properties:
+            desc = self._properties['bank_description'].value
         else:
             desc = self.description
         return hash((self.amount, self.sign, self.date, desc))
 
+    # true if the transaction's text changed since it was parsed
+    @property
+    def dirty(self):
+        line = getattr(self, 'line', None)
+        return line is not None and line.dirty
+    @dirty.setter
+    def dirty(self, value):
+        self.line.dirty = value
+
     def id(self):
         h = hash(self)
         if h < 0: h = maxint + h + 1
@@ -168,8 +327,9 @@ class Transaction(LedgerObject):
         if self.remainder_allocation != None:
             return Amount(0)
         remainder_amount = self.amount
-        for a in self.allocations.values():
-            remainder_amount -= a.amount
+        if self._allocations:
+            for a in self._allocations.values():
+                remainder_amount -= a.amount
         return remainder_amount
 
     def allocate_to(self, category_name, amount=None):
@@ -184,32 +344,44 @@ class Transaction(LedgerObject):
 
 
 class Allocation(LedgerObject):
+    __slots__ = ('parent_txn', 'amount', 'category', '_tags', 'line')
+
+    tags = _LazyContainer('_tags', list)
+
     def __init__(self, txn, amount, category):
         self.parent_txn = txn
         self.amount = mk_amount(amount)
         self.category = category
-        self.tags = []
+        self._tags = None
     def __repr__(self):
         return "%s->%s" % (str(self.amount), self.category.name)
 
 class RemainderAllocation(LedgerObject):
+    __slots__ = ('parent_txn', 'category', '_tags', 'line')
+
+    tags = _LazyContainer('_tags', list)
+
     def __init__(self, txn, category):
         self.parent_txn = txn
         self.category = category
-        self.tags = []
+        self._tags = None
     def __repr__(self):
         return "all->%s" % self.category.name
 
 
 class Tag(LedgerObject):
+    __slots__ = ('value', 'line')
+
     def __init__(self, val):
-        self.value = val
+        self.value = _intern(val)
     def __hash__(self):
         return hash(self.value)
 
 class Property(LedgerObject):
+    __slots__ = ('key', 'value', 'line')
+
     def __init__(self, key, value):
-        self.key = key
+        self.key = _intern(key)
         self.value = value
 
 
@@ -234,11 +406,145 @@ class Ledger(object):
         self.accounts     = {}   # keyed by account.name
         self.categories   = { 'unallocated': Category('unallocated')  }
         self.transactions = []
-
+        self._columns     = None
+        self._date_index  = None
+        self._by_account  = {}   # account name -> its transactions, in file order
+        self._by_category = {}   # category name -> transactions allocating to it
+        self._account_positions  = {}   # account name -> positions of its transactions
+        self._category_positions = {}   # category name -> positions of its transactions
+        self._filed       = {}   # id(t) -> [position, account name, category names, month]
+        self._checkpoints = None   # saved DateIndex checkpoints, see restore_checkpoints()
+
+    # adds a parsed transaction to the ledger and its indexes; allocations
+    # parsed after this are filed with add_allocation()
+    def add_transaction(self, t):
+        names = set(t._allocations) if t._allocations else set()
+        pos = len(self.transactions)
+        self._filed[id(t)] = [pos, t.account.name, names, month_key(t.date)]
+        self.transactions.append(t)
+        self._file(self._by_account, self._account_positions, t.account.name, t, pos)
+        for name in names:
+            self._file(self._by_category, self._category_positions, name, t, pos)
+        self.invalidate()
+
+    # files the last transaction added under a category it now allocates to
+    def add_allocation(self, t, name):
+        entry = self._filed[id(t)]
+        entry[2].add(name)
+        self._file(self._by_category, self._category_positions, name, t, entry[0])
+        self.invalidate()
+
+    # refiles an edited transaction under its current account and categories;
+    # only the indexes it moves between are touched
+    def reindex_transaction(self, t):
+        entry = self._filed.get(id(t))
+        if entry is None:
+            return
+        (pos, account_name, names, old_month) = entry
+        if t.account.name != account_name:
+            self._unfile(self._by_account, self._account_positions, account_name, t, pos)
+            self._file(self._by_account, self._account_positions, t.account.name, t, pos)
+            entry[1] = t.account.name
+        new_names = set(t.allocations)
+        for name in names - new_names:
+            self._unfile(self._by_category, self._category_positions, name, t, pos)
+        for name in new_names - names:
+            self._file(self._by_category, self._category_positions, name, t, pos)
+        entry[2] = new_names
+        entry[3] = month_key(t.date)
+
+        # balances from the earlier of the old and new months onward change
+        self._columns = None
+        if self._date_index is not None:
+            self._date_index.update(t, old_month)
+        elif self._checkpoints is not None:
+            (keys, checkpoints) = self._checkpoints
+            n = bisect.bisect_left(keys, min(old_month, entry[3]))
+            self._checkpoints = (keys[:n], checkpoints[:n])
+
+    # an index maps names to transactions in file order, alongside positions,
+    # which maps the same names to the sorted positions of those transactions
+    def _file(self, index, positions, name, t, pos):
+        txns = index.setdefault(name, [])
+        keys = positions.setdefault(name, [])
+        if not keys or keys[-1] < pos:
+            txns.append(t)
+            keys.append(pos)
+        else:
+            i = bisect.bisect_left(keys, pos)
+            txns.insert(i, t)
+            keys.insert(i, pos)
+
+    def _unfile(self, index, positions, name, t, pos):
+        txns = index[name]
+        keys = positions[name]
+        i = bisect.bisect_left(keys, pos)
+        del txns[i]
+        del keys[i]
+        if not txns:
+            del index[name]
+            del positions[name]
+
+    # drops the transactions after the first n, e.g. when a splice is rolled
+    # back
+    def truncate(self, n):
+        for t in self.transactions[n:]:
+            (pos, account_name, names, month) = self._filed.pop(id(t))
+            self._unfile(self._by_account, self._account_positions, account_name, t, pos)
+            for name in names:
+                self._unfile(self._by_category, self._category_positions, name, t, pos)
+        del self.transactions[n:]
+        self.invalidate()
+
+    # returns the transactions of an account, in file order
+    def account_transactions(self, name):
+        return self._by_account.get(name, [])
+
+    # returns the transactions allocating to a category, in file order
+    def category_transactions(self, name):
+        return self._by_category.get(name, [])
+
+    # drops the views derived from the transactions; called whenever
+    # transactions are added or removed
+    def invalidate(self):
+        self._columns     = None
+        self._date_index  = None
+        self._checkpoints = None
+
+    # returns the ledger_columns.LedgerColumns view of the transactions,
+    # building it if needed, or None when numpy isn't available
+    def columns(self):
+        if self._columns is None:
+            import ledger_columns
+            if ledger_columns.numpy is None:
+                return None
+            self._columns = ledger_columns.LedgerColumns(self)
+        return self._columns
+
+    # returns the ledger_index.DateIndex of the transactions, building it if
+    # needed
+    def date_index(self):
+        if self._date_index is None:
+            import ledger_index
+            self._date_index = ledger_index.DateIndex(self, self._checkpoints)
+            self._checkpoints = None
+        return self._date_index
+
+    # hands checkpoints saved with a snapshot of this ledger's parse (see
+    # DateIndex.saved_checkpoints()) to the date index built later
+    def restore_checkpoints(self, saved):
+        self._checkpoints = saved
+
+    # returns the balance checkpoints of the date index, materializing them
+    def saved_checkpoints(self):
+        index = self.date_index()
+        index.materialize()
+        return index.saved_checkpoints()
+
+    # adds other's accounts, categories and transactions to this ledger
     def append(self, other):
-        print "append t0: %d" % len(self.transactions)
         self.accounts.update(other.accounts)
         self.categories.update(other.categories)
-        self.transactions.extend(other.transactions)
-        print "append t1: %d" % len(self.transactions)
+        for t in other.transactions:
+            self.add_transaction(t)
 
@@ -0,0 +1,78 @@
+from ledger import Amount
+
+# numpy is optional; without it Ledger.columns() returns None and callers
+# fall back to walking the transactions
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+# A column-oriented copy of a ledger's transactions and allocations, for
+# aggregating balances with vectorized sums instead of per-object Amount
+# arithmetic.  It is derived from the ledger (see Ledger.columns()) and never
+# edited; the ledger drops it whenever its transactions change.
+class LedgerColumns(object):
+    def __init__(self, ledger):
+        txns = ledger.transactions
+        n = len(txns)
+
+        self.account_names  = sorted(ledger.accounts.keys())
+        self.category_names = sorted(ledger.categories.keys())
+        account_ids  = dict((name, i) for (i, name) in enumerate(self.account_names))
+        category_ids = dict((name, i) for (i, name) in enumerate(self.category_names))
+
+        # one row per transaction
+        self.dates    = numpy.fromiter((t.date.toordinal() for t in txns), numpy.int64, n)
+        self.cents    = numpy.fromiter((t.amount.cents*t.sign for t in txns), numpy.int64, n)
+        self.accounts = numpy.fromiter((account_ids[t.account.name] for t in txns), numpy.int64, n)
+        self.unallocated = numpy.fromiter((t.unallocated_amount().cents for t in txns),
+                numpy.int64, n)
+
+        # one row per (transaction, category, signed cents) allocation
+        alloc_txns  = []
+        alloc_cats  = []
+        alloc_cents = []
+        for (i, t) in enumerate(txns):
+            if not t._allocations:
+                continue
+            for a in t._allocations.values():
+                alloc_txns.append(i)
+                alloc_cats.append(category_ids[a.category.name])
+                alloc_cents.append(a.amount.cents*t.sign)
+        self.alloc_txns  = numpy.array(alloc_txns, numpy.int64)
+        self.alloc_cats  = numpy.array(alloc_cats, numpy.int64)
+        self.alloc_cents = numpy.array(alloc_cents, numpy.int64)
+
+    # mask of the transactions on or before date (all of them for None)
+    def _date_mask(self, date):
+        if date is None:
+            return numpy.ones(len(self.dates), bool)
+        return self.dates <= date.toordinal()
+
+    # bincount adds its weights as floats, which is exact only while every
+    # partial sum stays within 2**53 cents; beyond that the sums are made
+    # with (slower) integer adds
+    @staticmethod
+    def _sums(ids, cents, names):
+        if numpy.abs(cents).sum() < 2**53:
+            sums = numpy.bincount(ids, weights=cents, minlength=len(names))
+            return dict((name, Amount.from_cents(int(round(c)))) for (name, c) in zip(names, sums))
+        sums = numpy.zeros(len(names), numpy.int64)
+        numpy.add.at(sums, ids, cents)
+        return dict((name, Amount.from_cents(int(c))) for (name, c) in zip(names, sums))
+
+    # returns a map of account names to balances as of date
+    def account_balances(self, date=None):
+        mask = self._date_mask(date)
+        return self._sums(self.accounts[mask], self.cents[mask], self.account_names)
+
+    # returns a map of category names, plus '<unallocated>', to envelope
+    # balances as of date
+    def envelope_balances(self, date=None):
+        mask = self._date_mask(date)
+        amask = mask[self.alloc_txns]
+        balances = self._sums(self.alloc_cats[amask], self.alloc_cents[amask], self.category_names)
+        balances['<unallocated>'] = Amount.from_cents(int(self.unallocated[mask].sum()))
+        return balances
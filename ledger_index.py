@@ -0,0 +1,165 @@
+from ledger import Amount
+from type_utils import month_key
+
+import bisect
+
+
+# Cumulative balances in cents: per account, per category, and unallocated.
+class _Totals(object):
+    __slots__ = ('accounts', 'categories', 'unallocated')
+
+    def __init__(self, accounts=None, categories=None, unallocated=0):
+        self.accounts    = dict(accounts or {})
+        self.categories  = dict(categories or {})
+        self.unallocated = unallocated
+
+    def copy(self):
+        return _Totals(self.accounts, self.categories, self.unallocated)
+
+    def add(self, t):
+        name = t.account.name
+        self.accounts[name] = self.accounts.get(name, 0) + t.amount.cents*t.sign
+        if t._allocations:
+            for a in t._allocations.itervalues():
+                name = a.category.name
+                self.categories[name] = self.categories.get(name, 0) + a.amount.cents*t.sign
+        self.unallocated += t.unallocated_amount().cents
+
+    # the change from other to self
+    def minus(self, other):
+        return _Totals(
+                dict((k, c - other.accounts.get(k, 0)) for (k, c) in self.accounts.iteritems()),
+                dict((k, c - other.categories.get(k, 0)) for (k, c) in self.categories.iteritems()),
+                self.unallocated - other.unallocated)
+
+    def __getstate__(self):
+        return (self.accounts, self.categories, self.unallocated)
+
+    def __setstate__(self, state):
+        (self.accounts, self.categories, self.unallocated) = state
+
+
+# A month-bucketed index of a ledger's transactions with materialized balance
+# checkpoints: checkpoints[i] holds the cumulative balances through the end of
+# month keys[i].  Each month's transactions are kept sorted by date, and the
+# month of a queried date gets running totals through each of its dates, so
+# a balance as of a date is a checkpoint lookup plus a bisect within one
+# month.  Checkpoints and running totals are computed lazily, in order, and
+# an edit only drops the ones from the edited month onward.  Saved
+# checkpoints (see Ledger.restore_checkpoints()) are reused as long as the
+# months still line up.
+class DateIndex(object):
+    def __init__(self, ledger, saved=None):
+        self.ledger = ledger
+        self.months = {}   # month key -> transactions dated in that month, by date
+        self.dates  = {}   # month key -> the dates of those transactions
+        for t in ledger.transactions:
+            self.months.setdefault(month_key(t.date), []).append(t)
+        for (key, txns) in self.months.iteritems():
+            # the sort is stable, so same-day transactions keep their file order
+            txns.sort(key=lambda t: t.date)
+            self.dates[key] = [t.date for t in txns]
+        self.keys = sorted(self.months)
+        self.checkpoints = []
+        self.running = {}  # month key -> (its distinct dates, cumulative _Totals through each)
+        if saved is not None and saved[0] == self.keys[:len(saved[0])]:
+            self.checkpoints = list(saved[1])
+
+    # returns (month keys, checkpoints) in the form taken by saved
+    def saved_checkpoints(self):
+        return (self.keys[:len(self.checkpoints)], list(self.checkpoints))
+
+    # drops the checkpoints and running totals from month key onward
+    def invalidate_from(self, key):
+        del self.checkpoints[bisect.bisect_left(self.keys, key):]
+        for k in [k for k in self.running if k >= key]:
+            del self.running[k]
+
+    # moves an edited transaction from the old month bucket to its place by
+    # date in its current one
+    def update(self, t, old_key):
+        key = month_key(t.date)
+        self.invalidate_from(min(key, old_key))
+        txns = self.months[old_key]
+        i = next(i for (i, u) in enumerate(txns) if u is t)
+        del txns[i]
+        del self.dates[old_key][i]
+        if not txns:
+            del self.months[old_key]
+            del self.dates[old_key]
+            self.keys.remove(old_key)
+        if key not in self.months:
+            self.months[key] = []
+            self.dates[key] = []
+            bisect.insort(self.keys, key)
+        i = bisect.bisect_right(self.dates[key], t.date)
+        self.months[key].insert(i, t)
+        self.dates[key].insert(i, t.date)
+
+    def _checkpoint(self, i):
+        while len(self.checkpoints) <= i:
+            n = len(self.checkpoints)
+            totals = self.checkpoints[n-1].copy() if n > 0 else _Totals()
+            for t in self.months[self.keys[n]]:
+                totals.add(t)
+            self.checkpoints.append(totals)
+        return self.checkpoints[i]
+
+    # the running totals of month keys[i], as (distinct dates, cumulative
+    # _Totals through each of them)
+    def _running(self, i):
+        key = self.keys[i]
+        running = self.running.get(key)
+        if running is None:
+            totals = self._checkpoint(i-1).copy() if i > 0 else _Totals()
+            (dates, cumulative) = ([], [])
+            txns = self.months[key]
+            for (j, t) in enumerate(txns):
+                totals.add(t)
+                if j + 1 == len(txns) or txns[j+1].date != t.date:
+                    dates.append(t.date)
+                    cumulative.append(totals.copy())
+            running = self.running[key] = (dates, cumulative)
+        return running
+
+    # fills in every checkpoint
+    def materialize(self):
+        if self.keys:
+            self._checkpoint(len(self.keys) - 1)
+
+    # returns the cumulative _Totals as of date (None for all time)
+    def totals_as_of(self, date):
+        if date is None:
+            return self._checkpoint(len(self.keys) - 1) if self.keys else _Totals()
+        key = month_key(date)
+        i = bisect.bisect_right(self.keys, key) - 1
+        if i < 0:
+            return _Totals()
+        if self.keys[i] != key:
+            return self._checkpoint(i)
+        (dates, cumulative) = self._running(i)
+        j = bisect.bisect_right(dates, date) - 1
+        if j >= 0:
+            return cumulative[j]
+        return self._checkpoint(i-1) if i > 0 else _Totals()
+
+    # returns the change in _Totals over the dates after since, through date
+    def totals_between(self, since, date):
+        return self.totals_as_of(date).minus(self.totals_as_of(since))
+
+    # returns a map of account names to balances as of date (None for all
+    # time); with since, the change after that date instead
+    def account_balances(self, date=None, since=None):
+        totals = self.totals_between(since, date) if since else self.totals_as_of(date)
+        return dict((name, Amount.from_cents(totals.accounts.get(name, 0)))
+                for name in self.ledger.accounts)
+
+    # returns a map of category names, plus '<unallocated>', to envelope
+    # balances as of date (None for all time); with since, the change after
+    # that date instead
+    def envelope_balances(self, date=None, since=None):
+        totals = self.totals_between(since, date) if since else self.totals_as_of(date)
+        balances = dict((name, Amount.from_cents(totals.categories.get(name, 0)))
+                for name in self.ledger.categories)
+        balances['<unallocated>'] = Amount.from_cents(totals.unallocated)
+        return balances
@@ -1,19 +1,32 @@
 #!/usr/bin/env python
-from ofxparse import OfxParser
-from parser import Parser as LedgerParser, ParseError as LedgerParseError
+from ofxstream import iter_statement_transactions, sorted_by_date, StatementCache
+from bank_index import load_bank_index
+from parser import ParseError as LedgerParseError, write_ledger, parse_appended
+from parser_cache import parse_cached, snapshot_appended
+from reconcile import Reconciler
 from ledger import *
 from type_utils import *
 from config import config
 
 import sys
 import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import StringIO
+import tempfile
 
-from filter import filter_transaction
+from filter import filter_transaction, current_memo, save_memo
 
 
 
 progname = None
 args     = None
+index    = None   # BankIndex of the ledger
+ledger   = None   # see ledger_from_index()
+parsed   = None   # Parser of the whole ledger, when reconciling
+statement_cache = None
 
 
 txn_count_imported = 0
@@ -22,49 +35,44 @@ txn_count_new      = 0
 
 
 def amount_from_decimal(d):
-    return Amount(int(d*100))
+    return Amount.from_cents(int(d*100))
 
 def amount_to_decimal(a):
     return Decimal(str(a))
 
 
 
-# returns a dictionary mapping ofxid to transactions in the list
-# for only transactions that have an ofxid
-def ledger_transactions_by_ofxid(txns):
-    def generator():
-        for txn in txns:
-            if 'ofxid' in txn.properties:
-                yield txn.properties['ofxid'], txn
-            if 'ofx_id' in txn.properties:
-                yield txn.properties['ofx_id'], txn
-            if 'bankid' in txn.properties:
-                yield txn.properties['bankid'], txn
-            if 'bank_id' in txn.properties:
-                yield txn.properties['bank_id'], txn
-    return dict(generator())
-
-
-# filters out (and sorts) transactions from the ofx tree that have
-# a transaction with the same ofxid in the list of ledger transactions
-def filter(ofx, lgr_txns):
-    global txn_count_imported, txn_count_new
-    lgr_txns_by_ofxid = ledger_transactions_by_ofxid(lgr_txns)
-    ofx_txns = ofx.account.statement.transactions
-    txn_count_imported = len(ofx_txns)
-
-    filtered_ofx_txns = [t for t in ofx_txns if not t.id in lgr_txns_by_ofxid]
-    txn_count_new = len(filtered_ofx_txns)
-    if txn_count_new == 0:
-        sorted_ofx_txns = filtered_ofx_txns
-#    elif all(isinstance(txn, InvestmentTransaction) for txn in filtered_ofx_txns):
-#        if all(txn.settleDate is not None for txn in filtered_ofx_txns):
-#            sorted_ofx_txns = sorted(filtered_ofx_txns, key=lambda t: t.settleDate)
-#        else:
-#            sorted_ofx_txns = sorted(filtered_ofx_txns, key=lambda t: t.tradeDate)
-    else:
-        sorted_ofx_txns = sorted(filtered_ofx_txns, key=lambda t: t.date)
-    return sorted_ofx_txns
+# returns a ledger with just the accounts and categories declared in the
+# import tree of a BankIndex, which is all importing needs
+def ledger_from_index(index):
+    ledger = Ledger()
+    for name in index.account_names():
+        ledger.accounts[name] = Account(name)
+    for name in index.category_names():
+        ledger.categories[name] = Category(name)
+    return ledger
+
+
+# filters out transactions of the statement whose id is the bank id of a
+# transaction of the account in the BankIndex, or is in seen (the ids of the
+# statements imported before it, when there are several), or that the
+# Reconciler matches to a ledger transaction, and sorts the rest by date
+def filter(ofx_txns, index, account_name, seen=None, reconciler=None):
+    def new_txns():
+        global txn_count_imported, txn_count_new
+        for t in ofx_txns:
+            txn_count_imported += 1
+            if not t.id or (account_name, t.id) not in index:
+                if seen is not None and t.id:
+                    if t.id in seen:
+                        continue
+                    seen.add(t.id)
+                if reconciler is not None and \
+                        reconciler.match(amount_from_decimal(t.amount).cents, t.date, t) is not None:
+                    continue
+                txn_count_new += 1
+                yield t
+    return sorted_by_date(new_txns())
 
 
 def ofx_txn_to_ledger_txn(t, account):
@@ -77,7 +85,7 @@ def ofx_txn_to_ledger_txn(t, account):
     #t.sic
     #t.mcc
     #t.checknum
-    it = Transaction(Amount.from_cents(int(t.amount*100)), t.date, account)
+    it = Transaction(amount_from_decimal(t.amount), t.date, account)
     it.description = str(t.payee)
 
     if t.memo and len(t.memo) > 0 and t.memo != t.payee:
@@ -91,42 +99,193 @@ def ofx_txn_to_ledger_txn(t, account):
 
 def finalize_ledger_txn(it):
     if args.memo and 'bank_memo' not in it.properties:
-        it.properties['bank_memo'] = it.description
+        it.properties['bank_memo'] = Property('bank_memo', it.description)
         if args.memo == 'title':
             it.description = titlecase_str(it.description)
     return it
 
 
 
+# writes a transaction the way the parser writes new lines (see
+# Parser.update_transaction()), quoting names that need it, so the text
+# parses back to the same transaction
 def print_txn(t, f):
     datestr = datetime_to_date_str(t.date)
     dirstr = "from" if t.sign == -1 else "into"
-    amtstr = str(t.amount)
-    line = (datestr, " $", amtstr, " ", dirstr, " ", t.account.name, " ", quote_str(t.description))
-    for tok in line: f.write(tok)
-    f.write("\n")
+    f.write("%s $%s %s %s %s\n" % (datestr, str(t.amount), dirstr,
+            quote_str_if_needed(t.account.name), quote_str(t.description)))
     for (cat_name, a) in t.allocations.iteritems():
+        amtstr = "$" + str(a.amount) if a.amount else "all"
         if t.sign == -1:
-            if not a.amount:
-                line = ("    take all from ", cat_name)
-            else:
-                line = ("    take $", str(a.amount), " from ", cat_name)
+            f.write("    take %s from %s\n" % (amtstr, quote_str_if_needed(cat_name)))
         else:
-            if not a.amount:
-                line = ("    put all into ", cat_name)
-            else:
-                line = ("    put $", str(a.amount), " into ", cat_name)
-
-        for tok in line: f.write(tok)
-        f.write("\n")
+            f.write("    put %s into %s\n" % (amtstr, quote_str_if_needed(cat_name)))
     for tag in t.tags:
-        f.write("    tag ")
-        f.write(quote_str_if_needed(tag.value))
-        f.write("\n")
+        f.write("    tag %s\n" % quote_str_if_needed(tag.value))
     for p in t.properties.values():
-        line = ("    ", p.key, ": ", quote_str_if_needed(p.value))
-        for tok in line: f.write(tok)
+        f.write("    %s: %s\n" % (quote_str_if_needed(p.key), quote_str_if_needed(p.value)))
+
+# imports the statement files of one account, writing its new transactions
+# to f; returns (imported count, new count, the Reconciler's matches)
+def import_account(account_name, filenames, f):
+    global txn_count_imported, txn_count_new
+    (txn_count_imported, txn_count_new) = (0, 0)
+    laccount = ledger.accounts[account_name]
+    seen = set() if len(filenames) > 1 else None
+    reconciler = None
+    if parsed is not None:
+        reconciler = Reconciler(parsed.ledger.account_transactions(account_name), args.window)
+
+    def ofx_txns():
+        for filename in filenames:
+            if statement_cache is not None:
+                for t in statement_cache.transactions(filename):
+                    yield t
+                continue
+            with open(filename, 'rb') as fp:
+                for t in iter_statement_transactions(fp):
+                    yield t
+
+    for ot in filter(ofx_txns(), index, account_name, seen, reconciler):
+        lt = ofx_txn_to_ledger_txn(ot, laccount)
+        filter_transaction(ledger, lt)
+        lt = finalize_ledger_txn(lt)
+        print_txn(lt, f)
         f.write("\n")
+    return (txn_count_imported, txn_count_new, reconciler.matches if reconciler else [])
+
+# worker for import_batch(): returns (the text of the new transactions,
+# imported count, new count, matches, (new filter memo subs and titles
+# entries, lookups, hits))
+def _import_account(account_name, filenames):
+    memo = current_memo()
+    (subs, titles) = (set(memo.subs), set(memo.titles))
+    (lookups, hits) = (memo.lookups, memo.hits)
+    f = StringIO.StringIO()
+    (imported, new, matches) = import_account(account_name, filenames, f)
+    memo_delta = (
+            dict((d, r) for (d, r) in memo.subs.iteritems() if d not in subs),
+            dict((d, r) for (d, r) in memo.titles.iteritems() if d not in titles),
+            memo.lookups - lookups,
+            memo.hits - hits)
+    return (f.getvalue(), imported, new, matches, memo_delta)
+
+# Imports statements given as (filename, account name) pairs against the
+# loaded index and ledger.  The statements of each account are deduped
+# against each other too, and the new transactions are written to f grouped
+# by account, in the order the accounts first appear, each account's sorted
+# by date.  With more than one process the accounts are imported in parallel.
+# Returns a list of (account name, imported count, new count, matches), where
+# matches are the Reconciler's (see import_account()).
+def import_batch(statements, f, processes=None):
+    accounts = []
+    filenames = {}
+    for (filename, account_name) in statements:
+        if account_name not in filenames:
+            accounts.append(account_name)
+            filenames[account_name] = []
+        filenames[account_name].append(filename)
+    header = len(statements) > 1
+
+    def write_header(account_name):
+        if header:
+            f.write("# %s: %s\n\n" % (account_name, ", ".join(filenames[account_name])))
+
+    counts = []
+    if not processes > 1 or len(accounts) == 1:
+        for account_name in accounts:
+            write_header(account_name)
+            counts.append((account_name,) + import_account(account_name, filenames[account_name], f))
+        return counts
+
+    memo = current_memo()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = [pool.apply_async(_import_account, (account_name, filenames[account_name]))
+                for account_name in accounts]
+        for (account_name, result) in zip(accounts, results):
+            (text, imported, new, matches, (subs, titles, lookups, hits)) = result.get()
+            write_header(account_name)
+            f.write(text)
+            memo.merge(subs, titles)
+            memo.lookups += lookups
+            memo.hits += hits
+            counts.append((account_name, imported, new, matches))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+
+
+# the '<name>_' rewrite of path left for 'breadtrail commit' by filter or
+# check, or None; appending to path then would be undone by the commit
+def pending_rewrite(path):
+    new_path = path + '_'
+    return new_path if os.path.isfile(new_path) and os.path.getsize(new_path) > 0 else None
+
+# Appends text to path atomically: the file is copied to a temporary file
+# next to it, the text added with one write, and the copy fsync'd once and
+# renamed over the file.  A blank line is added first if the file doesn't
+# end with one.  Returns (the file's fingerprint before, its number of lines
+# before, the text as appended, its fingerprint after), both fingerprints
+# taken from what was copied and written rather than by rereading the file.
+# The fingerprint before is None if the file didn't end with a newline,
+# since the text then continues its last line.  Raises IOError if the file
+# has a pending rewrite, and parser.ParseError, leaving the file alone, if
+# the text doesn't parse.
+def append_to_file(path, text):
+    if pending_rewrite(path):
+        raise IOError("'%s' has a pending rewrite in '%s'" % (path, pending_rewrite(path)))
+    (dirname, basename) = os.path.split(path)
+    (fd, tmp_path) = tempfile.mkstemp(prefix='.' + basename + '.', dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            h = hashlib.sha1()
+            size = 0
+            linenum = 0
+            tail = ''
+            with open(path, 'rb') as fp:
+                mtime = os.fstat(fp.fileno()).st_mtime
+                while True:
+                    chunk = fp.read(1 << 16)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+                    linenum += chunk.count('\n')
+                    tail = (tail + chunk)[-2:]
+            fingerprint = (size, mtime, h.hexdigest())
+            if tail and not tail.endswith('\n'):
+                fingerprint = None
+                text = '\n\n' + text
+            elif tail and tail != '\n\n':
+                text = '\n' + text
+            parse_appended(path, text, linenum)
+            out.write(text)
+            h.update(text)
+            out.flush()
+            os.fsync(out.fileno())
+            st = os.fstat(out.fileno())
+            new_fingerprint = (st.st_size, st.st_mtime, h.hexdigest())
+        shutil.copymode(path, tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    dirfd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+    return (fingerprint, linenum, text, new_fingerprint)
+
+
 
 if __name__ == "__main__":
 
@@ -145,36 +304,104 @@ if __name__ == "__main__":
                         help='OFX account name to use (default: first')
     parser.add_argument('ofx_filename', metavar="FILENAME", help='OFX file to import')
     parser.add_argument('account_name', metavar="ACCOUNT", help='Ledger account name to compare against')
+    parser.add_argument('more_statements', metavar="FILENAME ACCOUNT", nargs='*',
+                        help='more OFX files and accounts to import in the same run')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='import the statements of this many accounts in parallel')
+    parser.add_argument('--append', metavar="LEDGER_FILE", default=None,
+                        help='append the new transactions to this file of the ledger instead of printing them')
+    parser.add_argument('--no-statement-cache', dest="statement_cache", action="store_false", default=True,
+                        help='parse the OFX files even if they were imported before')
+    parser.add_argument('--reconcile', action="store_true", default=False,
+                        help='match transactions to ledger transactions without a bank id by amount and date')
+    parser.add_argument('--window', metavar="DAYS", type=int,
+                        default=config.getint('import', 'reconcile_window'),
+                        help='most days apart reconciled transactions can be')
+    parser.add_argument('--tag-matches', dest="tag_matches", action="store_true", default=False,
+                        help='reconcile, and record the bank ids on the matched ledger transactions')
     progname = sys.argv[0]
     args = parser.parse_args(sys.argv[1:])
 
-    try:
-        p = LedgerParser(args.ledger or config.get_ledger_path())
-        p.parse()
-        ledger = p.ledger
-    except LedgerParseError as e:
-        sys.stderr.write("Error (%s:%d): %s" % (e.filename, e.linenum, e.msg))
-        if not e.msg.endswith('\n'):
-            sys.stderr.write('\n')
-        sys.exit(1)
-
-    if not args.account_name in ledger.accounts:
-        sys.stderr.write("Error: no account named '%s' in ledger" % args.account_name)
-        sys.exit(1)
-    laccount = ledger.accounts[args.account_name]
-    ltxns = [t for t in ledger.transactions if t.account is laccount]
-
-    ofx = OfxParser.parse(file(args.ofx_filename))
-    new_txns = filter(ofx, ltxns)
-
-    for ot in new_txns:
-        lt = ofx_txn_to_ledger_txn(ot, laccount)
-        filter_transaction(ledger, lt)
-        lt = finalize_ledger_txn(lt)
-        print_txn(lt, sys.stdout)
-        print
-
+    if len(args.more_statements) % 2 != 0:
+        parser.error("each extra FILENAME needs an ACCOUNT")
+    if args.tag_matches and args.append:
+        parser.error("--tag-matches and --append can't be used together")
+    statements = [(args.ofx_filename, args.account_name)] + \
+            zip(args.more_statements[0::2], args.more_statements[1::2])
+
+    if args.statement_cache and config.get_statement_cache_path():
+        statement_cache = StatementCache(config.get_statement_cache_path(),
+                config.getint('import', 'statement_cache_mb') << 20)
+
+    ledger_filename = args.ledger or config.get_ledger_path()
+    index = load_bank_index(ledger_filename)
+    ledger = ledger_from_index(index)
+
+    for (filename, account_name) in statements:
+        if not account_name in ledger.accounts:
+            sys.stderr.write("Error: no account named '%s' in ledger" % account_name)
+            sys.exit(1)
+
+    append_path = None
+    if args.append:
+        paths = [p for p in index.order if os.path.abspath(p) == os.path.abspath(args.append)]
+        if not paths:
+            sys.stderr.write("Error: '%s' is not a file of the ledger" % args.append)
+            sys.exit(1)
+        append_path = paths[0]
+        if pending_rewrite(append_path):
+            sys.stderr.write("Error: '%s' has changes pending in '%s'; run 'breadtrail commit' first\n" %
+                    (append_path, pending_rewrite(append_path)))
+            sys.exit(1)
+
+    if args.reconcile or args.tag_matches:
+        try:
+            parsed = parse_cached(ledger_filename)
+        except LedgerParseError as e:
+            sys.stderr.write("Error (%s:%d): %s" % (e.filename, e.linenum, e.msg))
+            if not e.msg.endswith('\n'):
+                sys.stderr.write('\n')
+            sys.exit(1)
+
+    out = StringIO.StringIO() if append_path else sys.stdout
+    counts = import_batch(statements, out, args.jobs)
+
+    if parsed is not None:
+        for (account_name, imported, new, matches) in counts:
+            txns = list(parsed.ledger.account_transactions(account_name))
+            for (pos, st) in matches:
+                lt = txns[pos]
+                sys.stderr.write("reconciled %r with bank id %s\n" % (lt, st.id))
+                if args.tag_matches:
+                    lt.properties['bank_id'] = Property('bank_id', str(st.id))
+                    parsed.update_transaction(lt)
+        if args.tag_matches:
+            write_ledger(parsed)
+
+    if append_path and out.getvalue():
+        # titlecased descriptions come back as unicode
+        text = out.getvalue()
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        try:
+            (fingerprint, linenum, text, new_fingerprint) = append_to_file(append_path, text)
+        except LedgerParseError as e:
+            sys.stderr.write("Error (%s:%d): %s; nothing was appended\n" % (e.filename, e.linenum, e.msg))
+            sys.exit(1)
+        if fingerprint is not None:
+            index.appended(append_path, fingerprint, linenum, text, new_fingerprint)
+            snapshot_appended(ledger_filename, append_path, fingerprint, linenum, text,
+                    new_fingerprint)
+
+    save_memo()
     if (args.output_stats):
-        print "%d imported transactions, %d new" % (txn_count_imported, txn_count_new)
+        if len(counts) > 1:
+            for (account_name, imported, new, matches) in counts:
+                print "%s: %d imported transactions, %d new%s" % (account_name, imported, new,
+                        ", %d reconciled" % len(matches) if parsed else "")
+        print "%d imported transactions, %d new%s" % (
+                sum(c[1] for c in counts), sum(c[2] for c in counts),
+                ", %d reconciled" % sum(len(c[3]) for c in counts) if parsed else "")
+        print current_memo().stats()
 
 
@@ -0,0 +1,323 @@
+from ofxparse import OfxParser
+from ofxparse.ofxparse import OfxParserException
+
+import HTMLParser
+import codecs
+import cPickle as pickle
+import decimal
+import hashlib
+import heapq
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+
+# The transactions of a statement, read straight from the <STMTTRN> blocks of
+# an OFX/QFX file as it streams in instead of building the document tree the
+# way OfxParser does.  Only the fields importing needs are kept, with the
+# same values OfxParser would give them.
+class StatementTransaction(object):
+    __slots__ = ('id', 'date', 'amount', 'payee', 'memo', 'type')
+
+    def __getstate__(self):
+        return (self.id, self.date, self.amount, self.payee, self.memo, self.type)
+
+    def __setstate__(self, state):
+        (self.id, self.date, self.amount, self.payee, self.memo, self.type) = state
+
+
+_unescape = HTMLParser.HTMLParser().unescape
+
+# the encoding OfxParser would decode the file with, from its SGML headers
+def _encoding(head):
+    headers = {}
+    for line in re.split(r'\r?\n', head[:head.find('<')]):
+        if not line.strip():
+            break
+        (key, value) = line.split(':', 1)
+        headers[key.strip().upper()] = value.strip()
+    if headers.get('ENCODING') == 'USASCII':
+        return 'cp' + headers.get('CHARSET', '1252')
+    if headers.get('ENCODING') in ('UNICODE', 'UTF-8'):
+        return 'utf-8'
+    return 'ascii'
+
+# yields (lowercased tag, text up to the next tag) for every tag in the file,
+# reading and decoding it a chunk at a time
+def _elements(fp, chunk_size=1 << 16):
+    head = fp.read(chunk_size)
+    while '<' not in head:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        head += chunk
+    decoder = codecs.getincrementaldecoder(_encoding(head))()
+    buf = decoder.decode(head)
+    while True:
+        chunk = fp.read(chunk_size)
+        buf += decoder.decode(chunk, not chunk)
+        pos = 0
+        while True:
+            start = buf.find('<', pos)
+            end = buf.find('>', start) if start >= 0 else -1
+            if end < 0:
+                break
+            stop = buf.find('<', end)
+            if stop < 0:
+                if chunk:
+                    break   # the text may go on in the next chunk
+                stop = len(buf)
+            yield (buf[start+1:end].lower(), buf[end+1:stop])
+            pos = stop
+        buf = buf[pos:]
+        if not chunk:
+            return
+
+# builds a StatementTransaction from the first value of each element in a
+# <STMTTRN> block, raising OfxParserException like OfxParser would
+def _transaction(values):
+    t = StatementTransaction()
+    t.type  = values.get('trntype', '').lower()
+    t.payee = values.get('name', '')
+    t.memo  = values.get('memo', '')
+    if 'trnamt' not in values:
+        raise OfxParserException("Missing Transaction Amount (a required field)")
+    try:
+        t.amount = decimal.Decimal(values['trnamt'])
+    except decimal.InvalidOperation:
+        raise OfxParserException("Invalid Transaction Amount: '%s'" % values['trnamt'])
+    if 'dtposted' not in values:
+        raise OfxParserException("Missing Transaction Date (a required field)")
+    try:
+        t.date = OfxParser.parseOfxDateTime(values['dtposted'])
+    except ValueError as e:
+        raise OfxParserException(str(e))
+    if 'fitid' not in values:
+        raise OfxParserException("Missing FIT id (a required field)")
+    t.id = values['fitid']
+    return t
+
+# Yields the StatementTransactions of the first bank or credit card
+# statement in an OFX/QFX file (the statement of OfxParser's ofx.account,
+# unless a bank statement follows a credit card one), in file order.
+# Memory use doesn't grow with the size of the file.
+def iter_statement_transactions(fp):
+    in_statement = False
+    values = None   # element values of the current <STMTTRN>
+    for (tag, text) in _elements(fp):
+        if tag[:1] in ('?', '!'):
+            continue
+        if values is not None:
+            if tag == '/stmttrn':
+                yield _transaction(values)
+                values = None
+            elif tag[:1] != '/' and tag not in values:
+                values[tag] = _unescape(text).strip()
+        elif tag in ('stmtrs', 'ccstmtrs'):
+            in_statement = True
+        elif tag in ('/stmtrs', '/ccstmtrs'):
+            if in_statement:
+                return
+        elif tag == 'stmttrn' and in_statement:
+            values = {}
+
+
+# bump whenever StatementTransaction or the entry format changes
+_statement_cache_version = 2
+
+# what reading a damaged cache entry can raise
+_entry_errors = (EOFError, ValueError, struct.error, zlib.error, pickle.UnpicklingError)
+
+# A cache of the statement transactions of OFX/QFX files keyed by the sha1 of
+# their content, so importing a file seen before skips parsing it.  Each file
+# gets an entry named after the hash holding batches of StatementTransaction
+# states, each pickled, zlib-compressed and prefixed with its length, and a
+# zero length at the end, so an entry is read a batch at a time and a
+# truncated one is noticed.  A hit touches the entry's mtime, and once the
+# cache grows past max_bytes the least recently used entries are evicted.
+# The cache is only ever an optimization: damaged entries are dropped and the
+# file parsed instead, and a cache that can't be written still serves hits.
+class StatementCache(object):
+    batch_size = 1024
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, filename):
+        h = hashlib.sha1()
+        with open(filename, 'rb') as fp:
+            while True:
+                chunk = fp.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return os.path.join(self.path, '%s.%d.z' % (h.hexdigest(), _statement_cache_version))
+
+    # yields what iter_statement_transactions() would for filename, from
+    # the cache if possible; otherwise the file is parsed and the transactions
+    # are cached once they have all been read
+    def transactions(self, filename):
+        entry = self._entry_path(filename)
+        n = 0   # transactions yielded from the entry
+        try:
+            fp = open(entry, 'rb')
+        except IOError:
+            fp = None
+        if fp is not None:
+            try:
+                os.utime(entry, None)
+            except OSError:
+                pass
+            try:
+                with fp:
+                    for t in self._read_entry(fp):
+                        n += 1
+                        yield t
+                return
+            except _entry_errors:
+                # every batch yielded passed zlib's checksum, so parsing
+                # picks up after them
+                try:
+                    os.remove(entry)
+                except OSError:
+                    pass
+
+        out = self._create_entry()
+        try:
+            batch = []
+            with open(filename, 'rb') as fp:
+                for (i, t) in enumerate(iter_statement_transactions(fp)):
+                    if out is not None:
+                        batch.append(t.__getstate__())
+                        if len(batch) == self.batch_size:
+                            out = self._write_batch(out, batch)
+                            batch = []
+                    if i >= n:
+                        yield t
+            if out is not None and batch:
+                out = self._write_batch(out, batch)
+            if out is not None:
+                out = self._write_batch(out, [])
+            if out is not None:
+                self._commit_entry(out, entry)
+                out = None
+        finally:
+            if out is not None:
+                self._abandon_entry(out)
+
+    def _read_entry(self, fp):
+        while True:
+            header = fp.read(4)
+            (size,) = struct.unpack('<I', header)
+            if not size:
+                return
+            data = fp.read(size)
+            if len(data) != size:
+                raise EOFError("truncated statement cache entry")
+            for state in pickle.loads(zlib.decompress(data)):
+                t = StatementTransaction()
+                t.__setstate__(state)
+                yield t
+
+    # returns a temporary file for a new entry, or None if the cache can't
+    # be written
+    def _create_entry(self):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            (fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            os.close(fd)
+            return open(tmp_path, 'wb')
+        except (IOError, OSError):
+            return None
+
+    # writes a batch (an empty one ends the entry) to the temporary file of
+    # an entry, returning it, or None if writing failed and it was abandoned
+    def _write_batch(self, out, batch):
+        data = zlib.compress(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)) if batch else ''
+        try:
+            out.write(struct.pack('<I', len(data)))
+            out.write(data)
+        except (IOError, OSError):
+            self._abandon_entry(out)
+            return None
+        return out
+
+    def _commit_entry(self, out, entry):
+        try:
+            out.close()
+            os.rename(out.name, entry)
+        except (IOError, OSError):
+            self._abandon_entry(out)
+            return
+        self._evict(entry)
+
+    def _abandon_entry(self, out):
+        try:
+            out.close()
+        except (IOError, OSError):
+            pass
+        try:
+            os.remove(out.name)
+        except OSError:
+            pass
+
+    # removes the least recently used entries, except keep, until the cache
+    # fits in max_bytes
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.z'):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        total = sum(size for (mtime, path, size) in entries)
+        for (mtime, path, size) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Returns an iterator over transactions sorted (stably) by date.  They are
+# sorted in runs of run_size that are spilled to temporary files and merged,
+# so only one run is held in memory.
+def sorted_by_date(txns, run_size=10000):
+    runs = []
+    run = []
+    for (i, t) in enumerate(txns):
+        run.append((t.date, i, t))
+        if len(run) == run_size:
+            runs.append(_spill(sorted(run)))
+            run = []
+    run.sort()
+    if not runs:
+        return (t for (date, i, t) in run)
+    runs.append(iter(run))
+    return (t for (date, i, t) in heapq.merge(*runs))
+
+def _spill(run):
+    fp = tempfile.TemporaryFile()
+    for entry in run:
+        pickle.dump(entry, fp, pickle.HIGHEST_PROTOCOL)
+    fp.seek(0)
+    return _unspill(fp)
+
+def _unspill(fp):
+    with fp:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
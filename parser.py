@@ -3,7 +3,12 @@ from type_utils import *
 from parser_tokenize import Token, Line, LineParseError
 
 import StringIO
+import cPickle as pickle
+import cStringIO
 import datetime
+import filecmp
+import hashlib
+import multiprocessing
 import os
 
 
@@ -22,27 +27,102 @@ class ParseError(Exception):
 
 
 class LineReader(object):
-    def __init__(self, filename):
+    def __init__(self, filename, fp=None):
         self.filename = filename
-        self.reader = open(filename)
+        self.reader = fp if fp is not None else open(filename)
         self.linenum = 0
 
 
-# returns subcommands divided into (both, only_list1, only_list2)
-def intersect_subcommands(list1, list2):
-    both       = [x for x in list1 if x in list2]
-    only_list1 = [x for x in list1 if x not in list2]
-    only_list2 = [x for x in list2 if x not in list1]
-    return (both, only_list1, only_list2)
+# Reads a whole file, returning (its text, its fingerprint as read) with the
+# fingerprint shaped like file_utils.file_fingerprint()'s.  The mtime is
+# taken before reading, so a file that changes while it is read doesn't match
+# its fingerprint afterwards.
+def read_fingerprinted(filename):
+    with open(filename, 'rb') as fp:
+        mtime = os.fstat(fp.fileno()).st_mtime
+        text = fp.read()
+    return (text, (len(text), mtime, hashlib.sha1(text).hexdigest()))
+
+
+# Brings the subcommands of type cls in line with objects, matching them up by
+# key rather than by equality.  A matched subcommand is replaced in place by
+# its object, which takes over the subcommand's line; objects without one are
+# appended and subcommands without one are removed.  update is called on
+# every object to make its line reflect it.
+def sync_subcommands(subcommands, cls, objects, key, update):
+    current = {}
+    for (i, sc) in enumerate(subcommands):
+        if isinstance(sc, cls):
+            current[key(sc)] = i
+    for obj in objects:
+        i = current.pop(key(obj), None)
+        if i is None:
+            update(obj)
+            subcommands.append(obj)
+            continue
+        sc = subcommands[i]
+        if sc is not obj:
+            obj.line = sc.line
+            subcommands[i] = obj
+        update(obj)
+    if current:
+        stale = set(current.values())
+        subcommands[:] = [sc for (i, sc) in enumerate(subcommands) if i not in stale]
+
+
+
+# returns the commands that belong to the file itself from a parser's command
+# list, skipping the commands spliced in from imported files
+def own_commands(commands):
+    own = []
+    depth = 0
+    for cmd in commands:
+        if depth == 0:
+            own.append(cmd)
+        if isinstance(cmd, ImportFile):
+            depth += 1
+        elif isinstance(cmd, EndOfFile):
+            depth -= 1
+    return own
+
+
+# the parsed commands of one file in the import tree; imports of other files
+# appear only as their ImportFile command.  The fingerprint is that of the
+# text the commands were parsed from.
+class Fragment(object):
+    def __init__(self, filename, commands, fingerprint=None):
+        self.filename = filename
+        self.commands = commands
+        self.fingerprint = fingerprint
+
+
+# fragments shared by all the parsers of one import tree: 'reusable' holds
+# fragments of files known to be unchanged, each of which can be spliced in
+# at most once; 'fragments' collects the fragment of every file as parsed
+class FragmentCache(object):
+    def __init__(self, reusable=None):
+        self.reusable  = reusable or {}  # keyed by filename
+        self.fragments = {}              # keyed by filename
+
+    def take(self, filename):
+        return self.reusable.pop(filename, None)
+
+    def put(self, fragment):
+        self.fragments[fragment.filename] = fragment
 
 
 
 class Parser(object):
 
-    def __init__(self, filename, ledger=Ledger()):
+    def __init__(self, filename, ledger=Ledger(), fragments=None):
         self.filename = filename
-        self.commands = []        # list of commands parsed
-        self.ledger = ledger      # ledger to parser into
+        self.commands = []         # list of commands parsed
+        self.ledger = ledger       # ledger to parser into
+        self.fragments = fragments # FragmentCache for the import tree, or None
+        self.deferred = False      # leave account/category references unchecked
+        self.streaming = False     # see iter_transactions()
+        self.pending_import = None # file to stream next when streaming
+        self.placeholders = {}     # deferred mode's stand-ins, see lookup_account()
 
 
     # make sure the last top-level command is of type t
@@ -56,6 +136,29 @@ class Parser(object):
         return len(self.commands) > 0 and hasattr(self.commands[-1], 'subcommands')
 
 
+    # In deferred mode a file is parsed on its own (see parse_fragments), so
+    # names defined in other files resolve to placeholders that are checked
+    # and rebound when the fragment is spliced into the real ledger.  There
+    # is one placeholder per name, so a fragment pickles each only once.
+    def lookup_account(self, name):
+        if name in self.ledger.accounts:
+            return self.ledger.accounts[name]
+        if self.deferred:
+            if ('account', name) not in self.placeholders:
+                self.placeholders[('account', name)] = Account(name)
+            return self.placeholders[('account', name)]
+        raise ParseError(self.reader, "account '%s' not defined" % name)
+
+    def lookup_category(self, name):
+        if name in self.ledger.categories:
+            return self.ledger.categories[name]
+        if self.deferred:
+            if ('category', name) not in self.placeholders:
+                self.placeholders[('category', name)] = Category(name)
+            return self.placeholders[('category', name)]
+        raise ParseError(self.reader, "category '%s' not defined" % name)
+
+
     def parse_date_or_raise(self, str):
         d = datetime_from_str(str)
         if d: return d
@@ -116,7 +219,7 @@ class Parser(object):
         tokens = line.token_values()
         if len(tokens) != 2:
             raise ParseError(self.reader, "wrong number of arguments")
-        goal = CategoryGoal(Amount(tokens[1]))
+        goal = CategoryGoal(Amount.from_str(tokens[1]))
         goal.line = line
         if self.commands[-1].goal:
             raise ParseError(self.reader, "multiple goals for category")
@@ -138,10 +241,8 @@ class Parser(object):
         tokens = line.token_values()
         if len(tokens) != 5:
             raise ParseError(self.reader, "wrong number of arguments (%d)" % len(tokens))
-        amount = Amount(tokens[1])
-        if not tokens[3] in self.ledger.accounts:
-            raise ParseError(self.reader, "account '%s' not defined" % tokens[3])
-        account = self.ledger.accounts[tokens[3]]
+        amount = Amount.from_str(tokens[1])
+        account = self.lookup_account(tokens[3])
         if tokens[2].lower() == 'from':
             amount = -amount
         elif tokens[2].lower() != 'into':
@@ -149,11 +250,13 @@ class Parser(object):
         t = Transaction(amount, date, account)
         t.line = line
         t.description = tokens[4]
-        t.subcommands = []
-        self.ledger.transactions.append(t)
+        if not self.streaming:
+            self.ledger.add_transaction(t)
         self.commands.append(t)
 
     def update_transaction(self, t):
+        self.ledger.reindex_transaction(t)
+        subcommands = list(t.subcommands)
         if t.sign == 1:
             if t.line.tokens[2].value.lower() is not 'into':
                 t.line.tokens[2].value = 'into'
@@ -165,56 +268,44 @@ class Parser(object):
         t.line.rebuild()
 
         # update, add, and remove allocation subcommands to match t.allocations
-        (both, to_del, to_add) = intersect_subcommands(t.subcommands, t.allocations.values())
-        for a in both:
-            self.update_transaction_allocate(a)
-        for a in to_add:
-            self.update_transaction_allocate(a)
-            t.subcommands.append(a)
-        for a in to_del:
-            if not isinstance(a, Allocation): continue
-            t.subcommands.remove(a)
+        sync_subcommands(t.subcommands, Allocation, t.allocations.values(),
+                lambda a: a.category.name, self.update_transaction_allocate)
 
         # update the remainder allocation subcommand to match t.remainder_allocation
-        self.update_transaction_remainder_allocation(t.remainder_allocation)
-        (ra_sc, ra_sc_idx) = next(((i, sc) for i,sc in enumerate(t.subcommands) \
-                if isinstance(sc, RemainderAllocation)), (None, -1))
-        if ra_sc == t.remainder_allocation:
-            pass
-        elif ra_sc == None:
+        ra = t.remainder_allocation
+        ra_idx = next((i for (i, sc) in enumerate(t.subcommands) \
+                if isinstance(sc, RemainderAllocation)), None)
+        if ra is None:
+            if ra_idx is not None:
+                # need to delete it from subcommands
+                del t.subcommands[ra_idx]
+        elif ra_idx is None:
             # need to add it to subcommands (after any Allocation subcommands)
+            self.update_transaction_remainder_allocation(ra)
             a_sc_idx = -1
             for a_sc_idx in [i for i,sc in enumerate(t.subcommands) if isinstance(sc, Allocation)]:
                 pass
-            t.subcommands.insert(a_sc_idx + 1, t.remainder_allocation)
-        elif t.remainder_allocation == None:
-            # need to delete it from subcommands
-            del t.subcommands[ra_sc_idx]
+            t.subcommands.insert(a_sc_idx + 1, ra)
         else:
             # need to replace it in subcommands
-            t.subcommands[ra_sc_idx] = t.remainder_allocation
+            if t.subcommands[ra_idx] is not ra:
+                ra.line = t.subcommands[ra_idx].line
+                t.subcommands[ra_idx] = ra
+            self.update_transaction_remainder_allocation(ra)
 
         # update, add, and remove property subcommands to match t.properties
-        (both, to_del, to_add) = intersect_subcommands(t.subcommands, t.properties.values())
-        for prop in both:
-            self.update_transaction_property(prop)
-        for prop in to_add:
-            self.update_transaction_property(prop)
-            t.subcommands.append(prop)
-        for prop in to_del:
-            if not isinstance(prop, Property): continue
-            t.subcommands.remove(prop)
+        sync_subcommands(t.subcommands, Property, t.properties.values(),
+                lambda p: p.key, self.update_transaction_property)
 
         # update, add, and remove tag subcommands to match t.tags
-        (both, to_del, to_add) = intersect_subcommands(t.subcommands, t.tags)
-        for tag in both:
-            self.update_transaction_tag(tag)
-        for tag in to_add:
-            self.update_transaction_tag(tag)
-            t.subcommands.append(tag)
-        for tag in to_del:
-            if not isinstance(tag, Tag): continue
-            t.subcommands.remove(tag)
+        sync_subcommands(t.subcommands, Tag, t.tags,
+                lambda tag: tag.value, self.update_transaction_tag)
+
+        # added, removed or replaced subcommands change the transaction's text
+        # even when no line was rebuilt
+        if len(subcommands) != len(t.subcommands) or \
+                any(a is not b for (a, b) in zip(subcommands, t.subcommands)):
+            t.dirty = True
 
 
     def assert_transaction_subcommand(self, subcommand):
@@ -236,11 +327,9 @@ class Parser(object):
                 raise ParseError(self.reader, "'take' allocation for expenditure transaction")
 
         cat_name = tokens[3]
-        if not cat_name in self.ledger.categories:
-            raise ParseError(self.reader, "category '%s' not defined" % cat_name)
+        cat = self.lookup_category(cat_name)
         if cat_name in ptxn.allocations:
             raise ParseError(self.reader, "multiple allocations to same category")
-        cat = self.ledger.categories[cat_name]
 
         if tokens[1] in ['all', 'rest', 'remainder']:
             if ptxn.remainder_allocation != None:
@@ -249,11 +338,13 @@ class Parser(object):
             ptxn.remainder_allocation = alloc
         else:
             try:
-                amount = Amount(tokens[1])
+                amount = Amount.from_str(tokens[1])
                 if amount < 0:
                     raise ParseError(self.reader, "allocation amounts must be positive")
                 alloc = Allocation(ptxn, amount, cat)
                 ptxn.allocations[cat_name] = alloc
+                if not self.streaming:
+                    self.ledger.add_allocation(ptxn, cat_name)
             except ValueError:
                 raise ParseError("invalid amount")
         if ptxn.sign == 1:
@@ -274,14 +365,12 @@ class Parser(object):
                 a.line = Line('    take $%s from %s\n' % (str(a.amount),
                      quote_str_if_needed(a.category.name)))
             return
-        diff = False
-        if a.amount != amount_from_str_or_none(a.line.tokens[1].value):
-            a.line.tokens[1] = '$' + cents_to_str(a.amount)
-            diff = True
-        if a.line.tokens[3] != a.category.name:
-            a.line.tokens[3] = a.category.name
-            diff = True
-        if diff:
+        # token values are unquoted, so a rebuilt line needs the category
+        # quoted again even when only the amount changed
+        if a.amount != amount_from_str_or_none(a.line.tokens[1].value) or \
+                a.line.tokens[3].value != a.category.name:
+            a.line.tokens[1].value = '$' + str(a.amount)
+            a.line.tokens[3].value = quote_str_if_needed(a.category.name)
             a.line.rebuild()
 
     def update_transaction_remainder_allocation(self, ra):
@@ -293,8 +382,8 @@ class Parser(object):
             else:
                 ra.line = Line('    take all from %s\n' % quote_str_if_needed(ra.category.name))
             return
-        if ra.line.tokens[3] != ra.category.name:
-            ra.line.tokens[3] = ra.category.name
+        if ra.line.tokens[3].value != ra.category.name:
+            ra.line.tokens[3].value = quote_str_if_needed(ra.category.name)
             ra.line.rebuild()
 
 
@@ -310,10 +399,10 @@ class Parser(object):
 
     def update_transaction_tag(self, t):
         if not hasattr(t, 'line'):
-            t.line = Line('    tag %s\n' % quote_str_if_needed(t.val))
+            t.line = Line('    tag %s\n' % quote_str_if_needed(t.value))
             return
         if t.line.tokens[1].value != t.value:
-            t.line.tokens[1].value = t.value
+            t.line.tokens[1].value = quote_str_if_needed(t.value)
             t.line.rebuild()
 
 
@@ -336,7 +425,7 @@ class Parser(object):
             return
         if p.line.tokens[0].value[0:-1] != p.key or p.line.tokens[1].value != p.value:
             p.line.tokens[0].value = p.key + ':'
-            p.line.tokens[1].value = p.value
+            p.line.tokens[1].value = quote_str_if_needed(p.value)
             p.line.rebuild()
 
 
@@ -352,7 +441,12 @@ class Parser(object):
         ic.line = line
         ic.tokens = tokens
         self.commands.append(ic)
-        p = Parser(path, self.ledger)
+        if self.deferred:
+            return
+        if self.streaming:
+            self.pending_import = path
+            return
+        p = Parser(path, self.ledger, self.fragments)
         p.parse()
         self.commands.extend(p.commands)
 
@@ -383,61 +477,123 @@ class Parser(object):
     }
 
 
-    # Parses a file into the ledger
-    def parse(self):
-        self.reader = LineReader(self.filename)
-        for linenum, line in enumerate(self.reader.reader):
-            self.reader.linenum = linenum + 1
-            try:
-                tok_line = Line(line)
-            except LineParseError as error:
-                raise ParseError(self.reader, str(error) + ' (column %d)' % error.index)
-
-            # if no tokens, it's a blank line or comment
-            if len(tok_line.tokens) == 0:
-                if len(tok_line.suffix) == 0 or str.isspace(tok_line.suffix):
-                    # blank lines terminate the previous command
-                    self.finalize_last_command()
-                    ws = Whitespace()
-                    ws.line = tok_line
-                    self.commands.append(ws)
-                    continue
-                else:
-                    # comment- add to either commands or subcommands
-                    comment = Comment()
-                    comment.line = tok_line
-                    if self.can_subcommand():
-                        self.commands[-1].subcommands.append(comment)
-                    else:
-                        self.commands.append(comment)
-                    continue
-
-            cmd = tok_line.tokens[0].value.lower()
-
-            # if first token has a prefix, it's a subcommand; otherwise,
-            # it's a command or a transaction
-            if len(tok_line.tokens[0].prefix) == 0:
+    # rebinds a transaction from a reused fragment to the accounts and
+    # categories currently in the ledger; returns false if one is missing
+    def rebind_transaction(self, t):
+        account = self.ledger.accounts.get(t.account.name)
+        if account is None:
+            return False
+        t.account = account
+        allocs = t.allocations.values()
+        if t.remainder_allocation != None:
+            allocs.append(t.remainder_allocation)
+        for a in allocs:
+            cat = self.ledger.categories.get(a.category.name)
+            if cat is None:
+                return False
+            a.category = cat
+        return True
+
+    # adds the commands of an unchanged file to the ledger without reparsing
+    # it; imported files go through parse() so they can be reused or reparsed
+    # on their own.  If a reference no longer resolves, everything spliced is
+    # rolled back and false is returned so the file gets reparsed (and the
+    # error reported with its line number).
+    def splice_fragment(self, fragment):
+        accounts     = dict(self.ledger.accounts)
+        categories   = dict(self.ledger.categories)
+        num_txns     = len(self.ledger.transactions)
+        num_commands = len(self.commands)
+        for cmd in fragment.commands:
+            if isinstance(cmd, Transaction):
+                if not self.rebind_transaction(cmd):
+                    self.ledger.accounts     = accounts
+                    self.ledger.categories   = categories
+                    self.ledger.truncate(num_txns)
+                    del self.commands[num_commands:]
+                    return False
+                self.ledger.add_transaction(cmd)
+            elif isinstance(cmd, Account):
+                self.ledger.accounts[cmd.name] = cmd
+            elif isinstance(cmd, Category):
+                self.ledger.categories[cmd.name] = cmd
+            self.commands.append(cmd)
+            if isinstance(cmd, ImportFile):
+                p = Parser(cmd.path, self.ledger, self.fragments)
+                p.parse()
+                self.commands.extend(p.commands)
+        return True
+
+
+    # Parses one raw line of the file
+    def parse_line(self, line):
+        try:
+            tok_line = Line(line)
+        except LineParseError as error:
+            raise ParseError(self.reader, str(error) + ' (column %d)' % error.index)
+
+        # if no tokens, it's a blank line or comment
+        if len(tok_line.tokens) == 0:
+            if len(tok_line.suffix) == 0 or str.isspace(tok_line.suffix):
+                # blank lines terminate the previous command
                 self.finalize_last_command()
-                date = datetime_from_str(cmd)
-                if date:
-                    self.parse_transaction(date, tok_line)
-                elif cmd in Parser.commands:
-                    Parser.commands[cmd](self, tok_line)
+                ws = Whitespace()
+                ws.line = tok_line
+                self.commands.append(ws)
+            else:
+                # comment- add to either commands or subcommands
+                comment = Comment()
+                comment.line = tok_line
+                if self.can_subcommand():
+                    self.commands[-1].subcommands.append(comment)
                 else:
-                    raise ParseError(self.reader, 'unrecognized command: \'%s\'.' % cmd)
+                    self.commands.append(comment)
+            return
 
-            # for continuations, should have a previous transaction
-            elif not self.can_subcommand():
-                raise ParseError(self.reader, 'subcommand out of context.')
+        cmd = tok_line.tokens[0].value.lower()
+
+        # if first token has a prefix, it's a subcommand; otherwise,
+        # it's a command or a transaction
+        if len(tok_line.tokens[0].prefix) == 0:
+            self.finalize_last_command()
+            date = datetime_from_str(cmd)
+            if date:
+                self.parse_transaction(date, tok_line)
+            elif cmd in Parser.commands:
+                Parser.commands[cmd](self, tok_line)
+            else:
+                raise ParseError(self.reader, 'unrecognized command: \'%s\'.' % cmd)
 
-            # continuations are either a command or a property
+        # for continuations, should have a previous transaction
+        elif not self.can_subcommand():
+            raise ParseError(self.reader, 'subcommand out of context.')
+
+        # continuations are either a command or a property
+        else:
+            if cmd in Parser.continuation_commands:
+                Parser.continuation_commands[cmd](self, tok_line)
+            elif cmd.endswith(':'):
+                self.parse_transaction_property(tok_line)
             else:
-                if cmd in Parser.continuation_commands:
-                    Parser.continuation_commands[cmd](self, tok_line)
-                elif cmd.endswith(':'):
-                    self.parse_transaction_property(tok_line)
-                else:
-                    raise ParseError(self.reader, 'unrecognized subcommand: \'%s\'.' % cmd)
+                raise ParseError(self.reader, 'unrecognized subcommand: \'%s\'.' % cmd)
+
+
+    # Parses a file into the ledger
+    def parse(self):
+        if self.fragments is not None:
+            fragment = self.fragments.take(self.filename)
+            if fragment and self.splice_fragment(fragment):
+                self.fragments.put(fragment)
+                return self.ledger
+
+        if self.fragments is not None:
+            (text, fingerprint) = read_fingerprinted(self.filename)
+            self.reader = LineReader(self.filename, cStringIO.StringIO(text))
+        else:
+            self.reader = LineReader(self.filename)
+        for linenum, line in enumerate(self.reader.reader):
+            self.reader.linenum = linenum + 1
+            self.parse_line(line)
 
         # done parsing this file
         self.finalize_last_command()
@@ -445,4 +601,208 @@ class Parser(object):
         eof.line = None
         self.commands.append(eof)
 
+        if self.fragments is not None:
+            if self.deferred:
+                own = self.commands
+            else:
+                own = own_commands(self.commands)
+            self.fragments.put(Fragment(self.filename, own, fingerprint))
         return self.ledger
+
+
+    # pops the first n commands, yielding the transactions among them with
+    # their lines and subcommands dropped
+    def _release_commands(self, n):
+        done = self.commands[0:n]
+        del self.commands[0:n]
+        for cmd in done:
+            if isinstance(cmd, Transaction):
+                cmd.line = None
+                for sc in cmd.subcommands:
+                    sc.line = None
+                cmd.subcommands = None
+                yield cmd
+
+    # Parses the file and the files it imports as a stream, yielding each
+    # transaction once it is finalized.  Only accounts and categories are
+    # kept in the ledger; commands are dropped as soon as they are complete
+    # and the transactions yielded carry no lines, so this is for read-only
+    # use and nothing parsed this way can be written back.
+    def iter_transactions(self):
+        self.streaming = True
+        self.reader = LineReader(self.filename)
+        for linenum, line in enumerate(self.reader.reader):
+            self.reader.linenum = linenum + 1
+            self.parse_line(line)
+            if self.pending_import:
+                for t in self._release_commands(len(self.commands)):
+                    yield t
+                p = Parser(self.pending_import, self.ledger)
+                self.pending_import = None
+                for t in p.iter_transactions():
+                    yield t
+            elif len(self.commands) > 1:
+                # only the last command can still get subcommands
+                for t in self._release_commands(len(self.commands) - 1):
+                    yield t
+
+        self.finalize_last_command()
+        for t in self._release_commands(len(self.commands)):
+            yield t
+
+
+
+# parses one file in deferred mode for parse_fragments(), returning its
+# Fragment, or None so that the file is reparsed (and any error reported) in
+# order by the main process
+def _parse_fragment(filename):
+    p = Parser(filename, Ledger(), FragmentCache())
+    p.deferred = True
+    try:
+        p.parse()
+    except (ParseError, EnvironmentError):
+        return None
+    return p.fragments.fragments[filename]
+
+# worker for parse_fragments(): the Fragment comes back pickled, which is
+# much cheaper than the pool pickling the objects itself, and gets unpickled
+# by the main process while the workers carry on
+def _parse_fragment_pickled(filename):
+    fragment = _parse_fragment(filename)
+    return None if fragment is None else pickle.dumps(fragment, pickle.HIGHEST_PROTOCOL)
+
+# Parses text appended to the end of filename, which had linenum lines before
+# it, on its own in deferred mode; returns its commands through a final
+# EndOfFile, to take the place of the EndOfFile of the file's Fragment
+def parse_appended(filename, text, linenum):
+    p = Parser(filename, Ledger(), FragmentCache())
+    p.deferred = True
+    p.reader = LineReader(filename, StringIO.StringIO(text))
+    for line in p.reader.reader:
+        linenum += 1
+        p.reader.linenum = linenum
+        p.parse_line(line)
+    p.finalize_last_command()
+    eof = EndOfFile()
+    eof.line = None
+    p.commands.append(eof)
+    return p.commands
+
+# The pool only pays when there is more than one CPU and enough to parse:
+# the main process still unpickles and splices every fragment, about 0.5s per
+# MB of ledger against 1.25s per MB for parsing it (see
+# benchmarks/bench_parallel_parse.py), and starting the pool costs about 0.1s.
+parallel_parse_min_bytes = 512 << 10
+
+def _pool_pays(paths, processes):
+    if multiprocessing.cpu_count() < 2 or (processes is not None and processes < 2):
+        return False
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size >= parallel_parse_min_bytes
+
+# Parses the files of an import tree in a pool of worker processes and
+# returns a map of filenames to Fragments, ready to be spliced together in
+# import order by a Parser given a FragmentCache of them.  Files that already
+# have a reusable fragment are not parsed again.  The top-level file is
+# parsed here to find its imports, which decide whether the pool pays (see
+# _pool_pays()); if not, only that fragment is added and the rest is left to
+# the serial parse.  The tree is discovered as the fragments come in, so
+# files are parsed level by level.
+def parse_fragments(filename, reusable=None, processes=None):
+    fragments = dict(reusable or {})
+    seen = set()
+
+    # the files under path that need parsing, walking the known fragments
+    def unparsed(path):
+        if path in seen:
+            return []
+        seen.add(path)
+        if path not in fragments:
+            return [path]
+        return [p for cmd in fragments[path].commands if isinstance(cmd, ImportFile)
+                for p in unparsed(cmd.path)]
+
+    if filename not in fragments:
+        fragment = _parse_fragment(filename)
+        if fragment is None:
+            return fragments
+        fragments[filename] = fragment
+    todo = unparsed(filename)
+    if not _pool_pays(todo, processes):
+        return fragments
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = [(path, pool.apply_async(_parse_fragment_pickled, (path,))) for path in todo]
+        while pending:
+            (path, result) = pending.pop(0)
+            data = result.get()
+            if data is None:
+                continue
+            fragments[path] = pickle.loads(data)
+            for cmd in fragments[path].commands:
+                if isinstance(cmd, ImportFile):
+                    pending.extend((p, pool.apply_async(_parse_fragment_pickled, (p,)))
+                            for p in unparsed(cmd.path))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return fragments
+
+
+# Writes each file of the parser's import tree with changed lines to
+# '<name>_' for 'breadtrail commit' to move into place.  The lines of a file
+# are collected as it is walked and written in one go at its end if any of
+# them changed; untouched files aren't written or read at all, and any
+# '<name>_' left over for them is removed.
+def write_ledger(p):
+    class writer(object):
+        def __init__(self, filename):
+            self.filename = filename
+            self.lines = []
+            self.dirty = False
+        def write(self, line):
+            self.lines.append(line.raw_line)
+            if line.dirty:
+                self.dirty = True
+        def finish_and_test_same(self):
+            tmp_filename = self.filename + '_'
+            if not self.dirty:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                return True
+            with open(tmp_filename, 'w', 1 << 20) as fp:
+                fp.writelines(self.lines)
+            if not filecmp.cmp(self.filename, tmp_filename):
+                return False
+            os.remove(tmp_filename)
+            return True
+
+    out_stack = [writer(p.filename)]
+    #print ">>> output is now going to " + out_stack[-1].filename
+    for cmd in p.commands:
+        if cmd.line:
+            out_stack[-1].write(cmd.line)
+        if hasattr(cmd, 'subcommands'):
+            for scmd in cmd.subcommands:
+                if scmd.line:
+                    out_stack[-1].write(scmd.line)
+        if isinstance(cmd, ImportFile):
+            out_stack.append(writer(cmd.path))
+            #print ">>> output is now going to " + out_stack[-1].filename
+        elif isinstance(cmd, EndOfFile):
+            last_writer = out_stack.pop()
+            if last_writer.finish_and_test_same():
+                pass
+            #    print ">>> no difference when writing %s; deleting tmp file" % last_writer.filename
+            if len(out_stack) > 0: # still going
+                pass
+            #    print ">>> output is back to " + out_stack[-1].filename
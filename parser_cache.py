@@ -0,0 +1,130 @@
+from ledger import Ledger
+from parser import Parser, ParseError, FragmentCache, parse_fragments, parse_appended
+from ledger import Transaction
+from type_utils import month_key
+from file_utils import snapshot_path, fingerprint_matches
+
+import bisect
+import cPickle as pickle
+import os
+
+
+
+# bump whenever the pickled object model changes shape
+_snapshot_version = 8
+
+
+class Snapshot(object):
+    def __init__(self, filename, fragments, checkpoints=None):
+        self.version     = _snapshot_version
+        self.filename    = filename
+        self.fragments   = fragments   # map of filenames to parser.Fragments
+        self.checkpoints = checkpoints # ledger_index.DateIndex.saved_checkpoints()
+
+    # returns the fragments whose files are unchanged on disk
+    def current_fragments(self):
+        return dict((path, f) for (path, f) in self.fragments.iteritems()
+                if fingerprint_matches(path, f.fingerprint))
+
+
+# returns the snapshot of the import tree of filename, or None
+def load_snapshot(filename):
+    try:
+        with open(snapshot_path(filename), 'rb') as fp:
+            snapshot = pickle.load(fp)
+    except Exception:
+        return None
+    if not isinstance(snapshot, Snapshot) or snapshot.version != _snapshot_version:
+        return None
+    if snapshot.filename != filename:
+        return None
+    return snapshot
+
+
+# writes a snapshot of the fragments of an import tree and the balance
+# checkpoints of its ledger.  Each fragment keeps the fingerprint of the text
+# it was parsed from, so a file changed since then is reparsed next time; a
+# fragment without one is left out.  Failures are not fatal since the
+# snapshot is only ever an optimization.
+def save_snapshot(filename, fragments, checkpoints):
+    path = snapshot_path(filename)
+    tmp_path = path + '_'
+    fragments = dict((name, f) for (name, f) in fragments.iteritems() if f.fingerprint is not None)
+    try:
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(Snapshot(filename, fragments, checkpoints), fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, pickle.PicklingError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# parses filename into a fresh ledger, splicing in the snapshotted fragments
+# of unchanged files and reparsing only the files that changed; with more
+# than one process, the changed files are parsed in parallel.  When every
+# file was unchanged the snapshotted balance checkpoints are reused, otherwise
+# they are recomputed and saved with the new snapshot.
+def parse_cached(filename, processes=None):
+    snapshot = load_snapshot(filename)
+    reusable = snapshot.current_fragments() if snapshot else {}
+    snapshotted = dict(reusable)
+    if processes > 1:
+        reusable = parse_fragments(filename, reusable, processes)
+    cache = FragmentCache(reusable)
+    p = Parser(filename, Ledger(), cache)
+    p.parse()
+    stale = len(cache.reusable) > 0
+    if stale or any(snapshotted.get(path) is not f for (path, f) in cache.fragments.iteritems()):
+        save_snapshot(filename, cache.fragments, p.ledger.saved_checkpoints())
+    else:
+        p.ledger.restore_checkpoints(snapshot.checkpoints)
+    return p
+
+
+# parses filename from its snapshot alone, when it has a current fragment for
+# every file of the import tree, restoring the balance checkpoints; returns
+# None instead when some file would have to be parsed.  Nothing is saved.
+def parse_snapshot(filename):
+    snapshot = load_snapshot(filename)
+    if snapshot is None:
+        return None
+    reusable = snapshot.current_fragments()
+    if filename not in reusable or len(reusable) != len(snapshot.fragments):
+        return None
+    cache = FragmentCache(dict(reusable))
+    p = Parser(filename, Ledger(), cache)
+    p.parse()
+    if len(cache.reusable) > 0 or \
+            any(reusable.get(path) is not f for (path, f) in cache.fragments.iteritems()):
+        return None
+    p.ledger.restore_checkpoints(snapshot.checkpoints)
+    return p
+
+
+# Brings the snapshot of filename's import tree up to date after text was
+# appended to path, one of its files, which had the given fingerprint and
+# number of lines before and new_fingerprint after: the text is parsed on its
+# own and added to the file's fragment, and the balance checkpoints from the
+# first month the text has a transaction in are dropped.  If the snapshot
+# wasn't current for the file it is left alone, and the file gets reparsed as
+# usual.
+def snapshot_appended(filename, path, fingerprint, linenum, text, new_fingerprint):
+    snapshot = load_snapshot(filename)
+    if snapshot is None:
+        return
+    fragment = snapshot.fragments.get(path)
+    if fragment is None or fragment.fingerprint != fingerprint:
+        return
+    try:
+        commands = parse_appended(path, text, linenum)
+    except ParseError:
+        return
+    fragment.commands[-1:] = commands
+    fragment.fingerprint = new_fingerprint
+
+    checkpoints = snapshot.checkpoints
+    keys = [month_key(cmd.date) for cmd in commands if isinstance(cmd, Transaction)]
+    if checkpoints is not None and keys:
+        n = bisect.bisect_left(checkpoints[0], min(keys))
+        checkpoints = (checkpoints[0][:n], checkpoints[1][:n])
+    save_snapshot(filename, snapshot.fragments, checkpoints)
@@ -1,3 +1,6 @@
+import re
+
+
 class LineParseError(Exception):
     def __init__(self, index, msg=None):
         Exception.__init__(self, msg)
@@ -13,55 +16,78 @@ class Token(object):
         return self.prefix + self.value
 
 
+# characters that end or interrupt a plain run of token characters
+_space_re   = re.compile(r'[ \t\n\r\f\v]*')
+_special_re = re.compile(r'[ \t\n\r\f\v#"\'\\]')
+
 # returns (Token, i), or a string at the end
+#
+# Scans the line once, slicing runs of plain characters straight out of the
+# line instead of building the token a character at a time.  Quotes and
+# escapes split a token into several slices that are joined at the end.
 def _get_token(line, i):
+    n = len(line)
 
     # find the start of the token (after whitespace prefix)
     i0 = i
-    while True:
-        if i == len(line):
-            return (line[i0:], i)
-        if not str.isspace(line[i]):
-            break
-        i = i + 1
+    i = _space_re.match(line, i).end()
+    if i == n:
+        return (line[i0:], i)
     i1 = i
 
-    quote  = None
-    escape = None
-    token = ''
+    pieces = []
     while True:
-        if i == len(line):
-            if quote:
-                raise LineParseError(i, "unclosed quote")
-            if escape:
-                raise LineParseError(i, "unclosed escape")
-            return (Token(token, line[i0:i1]), i)
-
-        if escape:
-            token = token + line[i]
-            escape = None
-        elif line[i] == quote:
-            quote = None
-        elif line[i] == '#' and not quote:
+        m = _special_re.search(line, i)
+        if m is None:
+            pieces.append(line[i:])
+            return (Token(''.join(pieces), line[i0:i1]), n)
+        j = m.start()
+        if j > i:
+            pieces.append(line[i:j])
+        c = line[j]
+        if c == '"' or c == '\'':
+            k = line.find(c, j + 1)
+            if k < 0:
+                raise LineParseError(n, "unclosed quote")
+            pieces.append(line[j+1:k])
+            i = k + 1
+        elif c == '\\':
+            if j + 1 == n:
+                raise LineParseError(n, "unclosed escape")
+            pieces.append(line[j+1])
+            i = j + 2
+        elif c == '#':
+            token = ''.join(pieces)
             if token == '':
-                return (line[i0:], len(line))
-            break
-        elif str.isspace(line[i]) and not quote:
-            break
-        elif line[i] in '"\'' and not quote:
-            quote = line[i]
-        elif line[i] == '\\' and not quote:
-            escape = '\\'
+                return (line[i0:], n)
+            return (Token(token, line[i0:i1]), j)
         else:
-            token = token + line[i]
-        i = i + 1
-    return (Token(token, line[i0:i1]), i)
+            return (Token(''.join(pieces), line[i0:i1]), j)
 
 
 
 class Line(object):
+    dirty = False   # set once the text no longer matches the file it came from
+
     def __init__(self, rawline):
         self.raw_line = rawline
+        self.tokenize()
+
+    # snapshots pickle a line as just its raw text (and always clean); the
+    # tokens are recreated on first use, as most lines of a loaded snapshot
+    # are never looked at again
+    def __getstate__(self):
+        return self.raw_line
+    def __setstate__(self, rawline):
+        self.raw_line = rawline
+    def __getattr__(self, name):
+        if name == 'tokens' or name == 'suffix':
+            self.tokenize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def tokenize(self):
+        rawline = self.raw_line
         self.tokens = []
         self.suffix = ''
         i = 0
@@ -78,4 +104,7 @@ class Line(object):
         return [tok.value for tok in self.tokens]
 
     def rebuild(self):
-        self.raw_line = ''.join([str(t) for t in self.tokens]) + self.suffix
+        raw_line = ''.join([str(t) for t in self.tokens]) + self.suffix
+        if raw_line != self.raw_line:
+            self.raw_line = raw_line
+            self.dirty = True
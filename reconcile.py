@@ -0,0 +1,40 @@
+from bank_index import bank_id_keys
+
+import bisect
+from sys import maxint
+
+
+# Matches statement transactions to ledger transactions of the same account
+# that have no bank id, like hand-entered ones: the signed amounts must be
+# equal and the dates at most window days apart, and the closest date wins
+# (the earlier one on a tie).  Each ledger transaction is matched at most
+# once.  The candidates are kept sorted by (cents, date), so a match is a
+# bisection into the few with the right amount and dates rather than a scan
+# of the account's history.
+class Reconciler(object):
+    def __init__(self, ledger_txns, window):
+        self.window = window
+        candidates = sorted(((t.amount.cents*t.sign, t.date.toordinal(), i), t)
+                for (i, t) in enumerate(ledger_txns)
+                if not (t._properties and any(k in t._properties for k in bank_id_keys)))
+        self.keys = [key for (key, t) in candidates]   # (cents, date ordinal, position)
+        self.used = set()                              # indexes into keys already matched
+        self.matches = []   # (position in ledger_txns, statement transaction)
+
+    # matches a statement transaction of the given signed cents and date,
+    # returning the position of its ledger transaction, or None
+    def match(self, cents, date, st=None):
+        d = date.toordinal()
+        lo = bisect.bisect_left(self.keys, (cents, d - self.window))
+        hi = bisect.bisect_right(self.keys, (cents, d + self.window, maxint))
+        best = None
+        for i in xrange(lo, hi):
+            if i not in self.used and (best is None or
+                    abs(self.keys[i][1] - d) < abs(self.keys[best][1] - d)):
+                best = i
+        if best is None:
+            return None
+        self.used.add(best)
+        pos = self.keys[best][2]
+        self.matches.append((pos, st))
+        return pos
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from bank_index import load_bank_index
+from parser import read_fingerprinted
+
+
+def _write(path, text):
+    with open(path, 'w') as fp:
+        fp.write(text)
+
+def test_lookup_of_unicode_bank_ids(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path, 'account chk\n\n'
+            '2014-05-09 $5.00 from chk "Foo"\n    bank_id: caf\xc3\xa9-1\n\n'
+            '2014-05-10 $6.00 from chk "Bar"\n    ofxid: 1234\n')
+    index = load_bank_index(path)
+    assert index.lookup('chk', u'caf\xe9-1') == (path, 3)
+    assert index.lookup(u'chk', 'caf\xc3\xa9-1') == (path, 3)
+    assert index.lookup('chk', u'1234') == (path, 6)
+    assert index.lookup('chk', u'caf\xe9-2') is None
+    assert index.lookup('sav', u'1234') is None
+
+    # reloaded from disk, then extended by an append
+    index = load_bank_index(path)
+    assert index.lookup('chk', u'caf\xe9-1') == (path, 3)
+    (_, fingerprint) = read_fingerprinted(path)
+    text = '\n2014-05-11 $7.00 from chk "Baz"\n    bank_id: \xc3\xbcber\n'
+    with open(path, 'a') as fp:
+        fp.write(text)
+    (_, new_fingerprint) = read_fingerprinted(path)
+    index.appended(path, fingerprint, 7, text, new_fingerprint)
+    assert index.lookup('chk', u'\xfcber') == (path, 9)
+    assert load_bank_index(path).lookup('chk', u'\xfcber') == (path, 9)
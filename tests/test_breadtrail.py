@@ -0,0 +1,66 @@
+from breadtrail import BreadTrail
+from ledger import Amount, Ledger
+from parser_cache import parse_cached
+import ledger_columns
+
+import datetime
+import pytest
+
+
+def _write(path):
+    with open(path, 'w') as fp:
+        fp.write('account chk\naccount cc\ncategory rent\ncategory food\n\n')
+        for (date, amount, account, category) in [('2014-01-05', '-10.00', 'chk', 'rent'),
+                ('2014-01-20', '3.50', 'cc', None), ('2014-02-01', '-7.25', 'chk', 'food'),
+                ('2014-02-01', '-1.00', 'cc', 'food'), ('2014-03-31', '20.00', 'chk', 'rent')]:
+            sign = '-' if amount.startswith('-') else ''
+            fp.write('%s $%s %s %s "X"\n' % (date, amount.lstrip('-'),
+                    'from' if sign else 'into', account))
+            if category:
+                fp.write('    %s $%s %s %s\n' % ('take' if sign else 'put', amount.lstrip('-'),
+                        'from' if sign else 'into', category))
+
+def _balances(path, date):
+    bt = BreadTrail()
+    bt.options = type('Options', (object,), {'filename': path, 'parse_jobs': None})()
+    (L, accounts) = bt._account_balances(date)
+    (L, envelopes) = bt._envelope_balances(date)
+    nonzero = lambda d: dict((k, v.cents) for (k, v) in d.iteritems() if v != Amount(0))
+    return (nonzero(accounts), nonzero(envelopes))
+
+_dates = [None, datetime.datetime(2013, 12, 31), datetime.datetime(2014, 1, 20),
+        datetime.datetime(2014, 2, 1), datetime.datetime(2014, 2, 28)]
+_expected = [
+    ({'chk': 275, 'cc': 250}, {'rent': 1000, 'food': -825, '<unallocated>': 350}),
+    ({}, {}),
+    ({'chk': -1000, 'cc': 350}, {'rent': -1000, '<unallocated>': 350}),
+    ({'chk': -1725, 'cc': 250}, {'rent': -1000, 'food': -825, '<unallocated>': 350}),
+    ({'chk': -1725, 'cc': 250}, {'rent': -1000, 'food': -825, '<unallocated>': 350}),
+]
+
+def test_balances_streamed(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path)
+    assert [_balances(path, date) for date in _dates] == _expected
+
+def test_balances_from_the_date_index(tmpdir, monkeypatch):
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path)
+    parse_cached(path)
+    monkeypatch.setattr(ledger_columns, 'numpy', None)
+    monkeypatch.setattr(Ledger, 'columns', None)
+    assert [_balances(path, date) for date in _dates] == _expected
+
+def test_balances_from_the_columns(tmpdir, monkeypatch):
+    if ledger_columns.numpy is None:
+        pytest.skip("numpy isn't available")
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path)
+    parse_cached(path)
+    # balances for all time are summed over the columns; dated ones still
+    # come from the date index
+    monkeypatch.setattr(Ledger, 'date_index', None)
+    assert _balances(path, None) == _expected[0]
+    monkeypatch.undo()
+    monkeypatch.setattr(Ledger, 'columns', None)
+    assert [_balances(path, date) for date in _dates[1:]] == _expected[1:]
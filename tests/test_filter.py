@@ -0,0 +1,110 @@
+from filter import _subs, load_rules, read_rules, SubstitutionRules
+from file_utils import snapshot_path
+from type_utils import quote_str
+import file_utils
+
+import os
+import random
+import re
+
+
+def _write_rules(path, rules):
+    with open(path, 'w') as fp:
+        fp.write('# merchants\n\n')
+        for (pattern, description, category) in rules:
+            if ' ' in pattern or pattern[:1] in '"\'':
+                pattern = '"%s"' % pattern
+            fp.write('%s  %s %s\n' % (pattern, quote_str(description), category or ''))
+
+
+def test_patterns_are_read_raw(tmpdir, capsys):
+    path = str(tmpdir.join('rules'))
+    with open(path, 'w') as fp:
+        fp.write('IMPARK\\d+.*   "Impark Parking"  parking   # a comment\n')
+        fp.write("LOUISA'S\\s*CAFE.*  \"Louisa's Cafe\"\n")
+        fp.write('QFC#\\d+  QFC  food:groceries\n')
+        fp.write('"SEATTLE\\s+684-PARK .*"  "Seattle DOT"\n')
+        fp.write('    # an indented comment\n')
+        fp.write('"UNCLOSED.*  "Unclosed"\n')
+    assert read_rules(path) == [
+            ('IMPARK\\d+.*', 'Impark Parking', 'parking'),
+            ("LOUISA'S\\s*CAFE.*", "Louisa's Cafe", None),
+            ('QFC#\\d+', 'QFC', 'food:groceries'),
+            ('SEATTLE\\s+684-PARK .*', 'Seattle DOT', None)]
+    assert ':6): unclosed quote' in capsys.readouterr()[1]
+
+
+def test_builtin_rules_round_trip(tmpdir):
+    path = str(tmpdir.join('rules'))
+    rules = [r for r in _subs if len(r) == 3]
+    _write_rules(path, rules)
+    assert read_rules(path) == rules
+
+
+def test_cached_rules_are_not_rehashed(tmpdir, monkeypatch):
+    path = str(tmpdir.join('rules'))
+    _write_rules(path, [('FOO.*', 'Foo', None)])
+    os.utime(path, (1000, 1000))
+    assert load_rules(path).rules == [('FOO.*', 'Foo', None)]
+    hashed = []
+    sha1 = file_utils._file_sha1
+    monkeypatch.setattr(file_utils, '_file_sha1', lambda p: hashed.append(p) or sha1(p))
+    assert load_rules(path).rules == [('FOO.*', 'Foo', None)]
+    assert hashed == []
+
+    # an edit that keeps the size and mtime is only caught by the hash, which
+    # is taken when the cache isn't clearly newer than the file
+    _write_rules(path, [('BAR.*', 'Bar', None)])
+    os.utime(path, (1000, 1000))
+    os.utime(snapshot_path(path), (1001, 1001))
+    assert load_rules(path).rules == [('BAR.*', 'Bar', None)]
+    assert hashed == [path, path]   # checked, then fingerprinted anew
+
+
+_patterns = {}
+def _compiled(pattern):
+    if pattern not in _patterns:
+        _patterns[pattern] = re.compile(pattern)
+    return _patterns[pattern]
+
+# what SubstitutionRules.matches() must agree with: every rule tried in order
+# with re.match against the description as rewritten so far
+def _sequential(rules, description):
+    found = []
+    for rule in rules:
+        match = _compiled(rule[0]).match(description)
+        if match:
+            found.append((rule, match.group(0)))
+            description = match.expand(rule[1])
+    return found
+
+_rules = [
+    ('NETFLIX.*', 'Netflix', None),
+    ('(?i)hulu.*', 'Hulu', None),
+    ('abc(?i)', 'Abc', None),
+    ('.*DOLLAR SHAVE.*', 'Dollar Shave Club', None),
+    ('[A-Z]+ PARKING.*', 'Parking', None),
+    ('AMAZON|AMZN', 'Amazon', None),
+    ('^QFC #(\\d+).*', 'QFC \\1', None),
+    ('SQ \\*HELLO.*', 'Hello', None),
+    ('COLOU?R.*', 'Colour', None),
+    ('A.B', 'AxB', None),
+    ('Netflix', 'Netflix Inc', None),    # only sees what the first rule wrote
+    ('Amazon', 'Amazon.com', None),
+    ('Hello', 'NETFLIX again', None),    # rewrites to what an earlier rule matches
+    ('NETFLIX again', 'Done', None),
+    ('\\d+', 'Number', None),
+]
+
+def test_matches_agree_with_sequential_re_match():
+    rnd = random.Random(7)
+    words = ['NETFLIX', 'netflix', 'HULU', 'hUlU', 'abc', 'ABC', 'DOLLAR SHAVE', 'IMPARK PARKING',
+            'AMAZON', 'AMZN', 'QFC #5847', 'QFC #', 'SQ *HELLO', 'SQ HELLO', 'COLOR', 'COLOUR',
+            'AxB', 'A.B', 'Netflix', 'Amazon', 'Hello', '42', ' ', 'X', '']
+    descriptions = [''.join(rnd.choice(words) for _ in xrange(rnd.randint(1, 3)))
+            for _ in xrange(3000)] + words
+    for rules in (_rules, [r for r in _subs if len(r) == 3]):
+        compiled = SubstitutionRules(rules)
+        for description in descriptions:
+            found = [(rule, match.group(0)) for (rule, match) in compiled.matches(description)]
+            assert found == _sequential(rules, description), description
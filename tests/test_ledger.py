@@ -0,0 +1,103 @@
+from ledger import Account, Allocation, Amount, Category, Ledger, Tag, Transaction
+
+import cPickle as pickle
+import datetime
+import pytest
+
+
+def _transaction():
+    return Transaction(-5, datetime.datetime(2014, 5, 1), Account('chk'))
+
+
+def test_reading_empty_containers_creates_none():
+    t = _transaction()
+    assert len(t.allocations) == 0 and not t.properties and list(t.tags) == []
+    assert 'rent' not in t.allocations and t.allocations.get('rent') is None
+    assert t.allocations.values() == [] and t.subcommands[:] == []
+    assert (t._allocations, t._properties, t._tags, t._subcommands) == (None, None, None, None)
+
+
+def test_writing_creates_the_container():
+    t = _transaction()
+    allocations = t.allocations
+    allocations['rent'] = Allocation(t, 5, Category('rent'))
+    t.tags.add(Tag('foo'))
+    t.subcommands.append(t.tags)
+    assert t._allocations is not None and list(allocations) == ['rent']
+    assert [tag.value for tag in t._tags] == ['foo'] and len(t._subcommands) == 1
+    assert t._properties is None
+
+    t.subcommands = None
+    assert len(t.subcommands) == 0 and t._subcommands is None
+
+
+def test_unwritten_containers_compare_like_empty_ones():
+    (t, u) = (_transaction(), _transaction())
+    u.allocations.clear()
+    assert u._allocations == {} and t == u
+
+
+def test_reindexing_keeps_file_order():
+    (chk, cc) = (Account('chk'), Account('cc'))
+    L = Ledger()
+    txns = [Transaction(-i, datetime.datetime(2014, 5, 1), chk if i % 2 else cc) for i in range(1, 9)]
+    for t in txns:
+        L.add_transaction(t)
+    for i in (5, 1, 7):
+        txns[i].account = chk
+        L.reindex_transaction(txns[i])
+    assert L.account_transactions('chk') == [txns[i] for i in (0, 1, 2, 4, 5, 6, 7)]
+    assert L.account_transactions('cc') == [txns[3]]
+    txns[3].account = chk
+    L.reindex_transaction(txns[3])
+    assert L.account_transactions('chk') == txns and L.account_transactions('cc') == []
+    L.truncate(3)
+    assert L.account_transactions('chk') == txns[:3]
+
+def test_append_files_the_other_ledgers_transactions(capsys):
+    (chk, cc, rent) = (Account('chk'), Account('cc'), Category('rent'))
+    (L, other) = (Ledger(), Ledger())
+    L.accounts['chk'] = chk
+    other.accounts['cc'] = cc
+    other.categories['rent'] = rent
+    t = Transaction(-5, datetime.datetime(2014, 5, 1), chk)
+    L.add_transaction(t)
+    u = Transaction(-7, datetime.datetime(2014, 5, 2), cc)
+    u.allocations['rent'] = Allocation(u, Amount(7), rent)
+    other.add_transaction(u)
+    L.date_index()
+    L.append(other)
+    assert capsys.readouterr() == ('', '')
+    assert L.transactions == [t, u] and sorted(L.accounts) == ['cc', 'chk']
+    assert L.account_transactions('cc') == [u] and L.category_transactions('rent') == [u]
+    assert L.date_index().account_balances(None)['cc'] == Amount(-7)
+
+
+def test_amounts_are_immutable():
+    a = Amount('12.34')
+    with pytest.raises(AttributeError):
+        a.cents = 5
+    with pytest.raises(AttributeError):
+        del a.cents
+    assert a.cents == 1234
+
+
+def test_small_amounts_are_shared():
+    for c in (-1024, -1, 0, 5, 10239):
+        assert Amount.from_cents(c) is Amount.from_cents(c)
+        if c >= 0:
+            assert Amount.from_str(str(Amount.from_cents(c))) is Amount.from_cents(c)
+        assert pickle.loads(pickle.dumps(Amount.from_cents(c), 2)) is Amount.from_cents(c)
+    assert Amount.from_cents(3) + Amount.from_cents(4) is Amount.from_cents(7)
+    for c in (-1025, 10240, 10**9):
+        assert Amount.from_cents(c) is not Amount.from_cents(c)
+        assert Amount.from_cents(c) == Amount.from_cents(c)
+
+
+def test_amounts_hash_like_what_they_equal():
+    for (amount, number) in [(Amount(3), 3), (Amount(-2), -2), (Amount(3), 3.0),
+            (Amount('1.50'), 1.5), (Amount.from_cents(-25), -0.25), (Amount('10000.01'), 10000.01)]:
+        assert amount == number and hash(amount) == hash(number)
+        assert {number: True}.get(amount) and amount in set([number])
+    assert Amount('1.50') != 1 and Amount('1.50') != 1.501
+    assert len(set([Amount('2.00'), Amount.from_cents(200), 2, 2.0])) == 1
@@ -0,0 +1,74 @@
+from ledger import Account, Allocation, Amount, Category, Ledger, Transaction
+import ledger_columns
+
+import datetime
+import random
+import pytest
+
+
+if ledger_columns.numpy is None:
+    pytest.skip("numpy isn't available", allow_module_level=True)
+
+
+def _ledger(rnd, amounts):
+    L = Ledger()
+    for name in ['chk', 'cc', 'savings']:
+        L.accounts[name] = Account(name)
+    for name in ['rent', 'food', 'fun']:
+        L.categories[name] = Category(name)
+    for _ in xrange(300):
+        cents = rnd.choice([-1, 1])*amounts(rnd)
+        date = datetime.datetime(2014, 1, 1) + datetime.timedelta(days=rnd.randint(0, 400))
+        t = Transaction(Amount.from_cents(cents), date, L.accounts[rnd.choice(['chk', 'cc'])])
+        for name in rnd.sample(['rent', 'food', 'fun'], rnd.randint(0, 2)):
+            t.allocations[name] = Allocation(t, Amount.from_cents(abs(cents)//3),
+                    L.categories[name])
+        L.add_transaction(t)
+    return L
+
+# the balances as of date, summed in plain python
+def _plain_sums(L, date):
+    accounts = dict((name, 0) for name in L.accounts)
+    envelopes = dict((name, 0) for name in L.categories)
+    envelopes['<unallocated>'] = 0
+    for t in L.transactions:
+        if date is None or t.date <= date:
+            accounts[t.account.name] += t.amount.cents*t.sign
+            for a in t.allocations.itervalues():
+                envelopes[a.category.name] += a.amount.cents*t.sign
+            envelopes['<unallocated>'] += t.unallocated_amount().cents
+    return (accounts, envelopes)
+
+def _check(L):
+    columns = L.columns()
+    dates = [None, datetime.datetime(2013, 12, 31), datetime.datetime(2016, 1, 1)]
+    dates += [t.date for t in L.transactions[:40]]
+    for date in dates:
+        (accounts, envelopes) = _plain_sums(L, date)
+        assert dict((k, v.cents) for (k, v) in columns.account_balances(date).iteritems()) == \
+                accounts, date
+        assert dict((k, v.cents) for (k, v) in columns.envelope_balances(date).iteritems()) == \
+                envelopes, date
+
+
+def test_balances_match_plain_sums():
+    _check(_ledger(random.Random(3), lambda rnd: rnd.randint(1, 100000)))
+
+# sums past 2**53 cents can't be made exactly with bincount's float weights
+def test_balances_of_large_amounts_are_exact():
+    _check(_ledger(random.Random(4), lambda rnd: rnd.randint(2**50, 2**53) + rnd.randint(0, 99)))
+    _check(_ledger(random.Random(5), lambda rnd: rnd.choice([1, 3, 2**53 - 1])))
+
+def test_balances_just_below_the_float_limit():
+    L = _ledger(random.Random(6), lambda rnd: rnd.randint(2**43, 2**44) + 1)
+    assert sum(abs(t.amount.cents) for t in L.transactions) < 2**53
+    _check(L)
+
+def test_columns_follow_added_transactions():
+    L = _ledger(random.Random(7), lambda rnd: rnd.randint(1, 1000))
+    before = L.columns()
+    t = Transaction(Amount.from_cents(12345), datetime.datetime(2014, 6, 1), L.accounts['savings'])
+    L.add_transaction(t)
+    assert L.columns() is not before
+    assert L.columns().account_balances()['savings'] == Amount.from_cents(12345)
+    _check(L)
@@ -0,0 +1,75 @@
+from ledger import Account, Allocation, Amount, Category, Ledger, Transaction
+from ledger_index import DateIndex
+
+import datetime
+import random
+
+
+def _ledger(rnd):
+    accounts = [Account('chk'), Account('cc')]
+    categories = [Category('rent'), Category('food')]
+    L = Ledger()
+    for _ in xrange(300):
+        cents = rnd.choice([-1, 1])*rnd.randint(1, 100000)
+        date = datetime.datetime(2014, 1, 1) + datetime.timedelta(days=rnd.randint(0, 400))
+        t = Transaction(Amount.from_cents(cents), date, rnd.choice(accounts))
+        if rnd.random() < 0.5:
+            c = rnd.choice(categories)
+            t.allocations[c.name] = Allocation(t, Amount.from_cents(abs(cents)//2), c)
+        L.add_transaction(t)
+    return L
+
+# the totals as of date, summed over every transaction
+def _brute_force(L, date):
+    (accounts, categories, unallocated) = ({}, {}, 0)
+    for t in L.transactions:
+        if date is None or t.date <= date:
+            accounts[t.account.name] = accounts.get(t.account.name, 0) + t.amount.cents*t.sign
+            for a in t.allocations.itervalues():
+                categories[a.category.name] = categories.get(a.category.name, 0) + a.amount.cents*t.sign
+            unallocated += t.unallocated_amount().cents
+    return (accounts, categories, unallocated)
+
+def _nonzero(d):
+    return dict((k, v) for (k, v) in d.iteritems() if v)
+
+def _check(L, index, dates):
+    for date in dates:
+        totals = index.totals_as_of(date)
+        (accounts, categories, unallocated) = _brute_force(L, date)
+        assert _nonzero(totals.accounts) == _nonzero(accounts), date
+        assert _nonzero(totals.categories) == _nonzero(categories), date
+        assert totals.unallocated == unallocated, date
+
+def _dates(L):
+    day = datetime.timedelta(days=1)
+    dates = [None, datetime.datetime(2013, 12, 31), datetime.datetime(2016, 1, 1)]
+    for t in L.transactions[:60]:
+        first = t.date.replace(day=1)
+        dates += [t.date, t.date - day, first, first - day, t.date.replace(day=15)]
+    return dates
+
+
+def test_totals_as_of_match_a_brute_force_sum():
+    L = _ledger(random.Random(1))
+    index = L.date_index()
+    # queried out of order, so running totals come before checkpoints too
+    dates = _dates(L)
+    random.Random(2).shuffle(dates)
+    _check(L, index, dates)
+
+    # a fresh index starting from saved checkpoints gives the same answers
+    _check(L, DateIndex(L, L.saved_checkpoints()), dates)
+
+
+def test_totals_as_of_after_edits():
+    rnd = random.Random(3)
+    L = _ledger(rnd)
+    index = L.date_index()
+    _check(L, index, _dates(L))
+    for t in rnd.sample(L.transactions, 20):
+        t.date += datetime.timedelta(days=rnd.randint(-40, 40))
+        L.reindex_transaction(t)
+        _check(L, index, [t.date, t.date.replace(day=1), None])
+    assert L.date_index() is index
+    _check(L, index, _dates(L))
@@ -0,0 +1,69 @@
+from ofximport import append_to_file, print_txn
+from file_utils import file_fingerprint
+from ledger import Account, Allocation, Amount, Category, Ledger, Property, Tag, Transaction
+from parser import Parser, ParseError
+
+import StringIO
+import datetime
+import pytest
+
+
+def test_append_to_file(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write('account chk\n')
+    before = file_fingerprint(path)
+    (fingerprint, linenum, text, new_fingerprint) = \
+            append_to_file(path, '2014-05-09 $78.00 from chk "Foo"\n')
+    assert (fingerprint, linenum) == (before, 1)
+    assert new_fingerprint == file_fingerprint(path)
+    with open(path) as fp:
+        assert fp.read() == 'account chk\n\n2014-05-09 $78.00 from chk "Foo"\n'
+
+
+def test_append_to_file_with_pending_rewrite(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write('account chk\n')
+    with open(path + '_', 'w') as fp:
+        fp.write('account chk "Checking"\n')
+    with pytest.raises(IOError):
+        append_to_file(path, '2014-05-09 $78.00 from chk "Foo"\n')
+    with open(path) as fp:
+        assert fp.read() == 'account chk\n'
+    with open(path + '_') as fp:
+        assert fp.read() == 'account chk "Checking"\n'
+
+
+def test_appended_transactions_parse_back(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write('account "jake chk"\ncategory "food:eating out"\n')
+    t = Transaction(Amount.from_cents(-875), datetime.datetime(2014, 5, 9), Account('jake chk'))
+    t.description = 'NETFLIX.COM "ONLINE" o\'reilly'
+    t.allocations['food:eating out'] = Allocation(t, Amount.from_cents(875), Category('food:eating out'))
+    t.tags.add(Tag('import unverified'))
+    t.properties['bank_memo'] = Property('bank_memo', 'REF #123 c:\\x')
+    out = StringIO.StringIO()
+    print_txn(t, out)
+    append_to_file(path, out.getvalue())
+
+    p = Parser(path, Ledger())
+    p.parse()
+    [u] = p.ledger.transactions
+    assert (u.account.name, u.description, str(u.amount)) == ('jake chk', t.description, '8.75')
+    assert [(name, str(a.amount)) for (name, a) in u.allocations.iteritems()] == \
+            [('food:eating out', '8.75')]
+    assert [tag.value for tag in u.tags] == ['import unverified']
+    assert u.properties['bank_memo'].value == 'REF #123 c:\\x'
+
+
+def test_append_to_file_refuses_what_does_not_parse(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write('account chk\n')
+    with pytest.raises(ParseError):
+        append_to_file(path, '2014-05-09 $8.75 from chk "Netflix"\n    take $8.75 from food:eating out\n')
+    with open(path) as fp:
+        assert fp.read() == 'account chk\n'
+    assert tmpdir.listdir() == [tmpdir.join('ledger.dat')]
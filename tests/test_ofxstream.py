@@ -0,0 +1,115 @@
+from ofxstream import iter_statement_transactions, StatementCache
+import ofxstream
+
+import os
+import shutil
+
+
+data_dir = os.path.dirname(os.path.abspath(__file__))
+test_ofx = os.path.join(data_dir, 'test.ofx')
+test_qfx = os.path.join(data_dir, 'test.qfx')
+
+
+def _states(txns):
+    return [t.__getstate__() for t in txns]
+
+def _parsed(filename):
+    with open(filename, 'rb') as fp:
+        return _states(iter_statement_transactions(fp))
+
+def _cache(tmpdir, max_bytes=1 << 20):
+    cache = StatementCache(str(tmpdir.join('cache')), max_bytes)
+    cache.batch_size = 7   # several batches per statement
+    return cache
+
+def _entries(cache):
+    return sorted(os.path.join(cache.path, name) for name in os.listdir(cache.path)
+            if name.endswith('.z'))
+
+def _no_parsing(fp):
+    raise AssertionError("parsed a cached statement")
+
+
+def test_miss_then_hit(tmpdir, monkeypatch):
+    cache = _cache(tmpdir)
+    expected = _parsed(test_ofx)
+    assert len(expected) > 3*cache.batch_size
+    assert _states(cache.transactions(test_ofx)) == expected
+    assert len(_entries(cache)) == 1
+    monkeypatch.setattr(ofxstream, 'iter_statement_transactions', _no_parsing)
+    assert _states(cache.transactions(test_ofx)) == expected
+
+
+def test_partly_read_miss_caches_nothing(tmpdir):
+    cache = _cache(tmpdir)
+    txns = cache.transactions(test_ofx)
+    next(txns)
+    txns.close()
+    assert _entries(cache) == []
+    assert os.listdir(cache.path) == []
+
+
+def test_corrupt_entry_is_replaced(tmpdir):
+    cache = _cache(tmpdir)
+    expected = _parsed(test_ofx)
+    list(cache.transactions(test_ofx))
+    [entry] = _entries(cache)
+    with open(entry, 'wb') as fp:
+        fp.write('junk' * 100)
+    assert _states(cache.transactions(test_ofx)) == expected
+    assert _entries(cache) == [entry]
+    assert _states(cache.transactions(test_ofx)) == expected
+
+
+def test_truncated_entry_is_replaced(tmpdir, monkeypatch):
+    cache = _cache(tmpdir)
+    expected = _parsed(test_ofx)
+    list(cache.transactions(test_ofx))
+    [entry] = _entries(cache)
+    with open(entry, 'rb') as fp:
+        data = fp.read()
+    for size in (len(data) - 4, len(data) - 10, len(data)//2, 2):
+        with open(entry, 'wb') as fp:
+            fp.write(data[:size])
+        assert _states(cache.transactions(test_ofx)) == expected
+        with monkeypatch.context() as m:
+            m.setattr(ofxstream, 'iter_statement_transactions', _no_parsing)
+            assert _states(cache.transactions(test_ofx)) == expected
+
+
+def test_read_only_cache(tmpdir, monkeypatch):
+    cache = _cache(tmpdir)
+    expected = _parsed(test_ofx)
+    list(cache.transactions(test_ofx))
+    def read_only(*args, **kwargs):
+        raise OSError(13, "Permission denied")
+    monkeypatch.setattr(os, 'utime', read_only)
+    monkeypatch.setattr(ofxstream.tempfile, 'mkstemp', read_only)
+    # hits are still served, and misses are parsed without being cached
+    monkeypatch.setattr(ofxstream, 'iter_statement_transactions', _no_parsing)
+    assert _states(cache.transactions(test_ofx)) == expected
+    monkeypatch.undo()
+    monkeypatch.setattr(ofxstream.tempfile, 'mkstemp', read_only)
+    assert _states(cache.transactions(test_qfx)) == _parsed(test_qfx)
+    assert len(_entries(cache)) == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+    cache = _cache(tmpdir)
+    copy = str(tmpdir.join('copy.ofx'))
+    shutil.copy(test_ofx, copy)
+    with open(copy, 'ab') as fp:
+        fp.write('\n')   # a different file with the same transactions
+
+    list(cache.transactions(test_ofx))
+    [a] = _entries(cache)
+    list(cache.transactions(test_qfx))
+    [b] = [e for e in _entries(cache) if e != a]
+    os.utime(b, (1000, 1000))
+    os.utime(a, (2000, 2000))
+
+    # room for two entries the size of a's
+    cache.max_bytes = 2*os.path.getsize(a)
+    list(cache.transactions(copy))
+    entries = _entries(cache)
+    assert len(entries) == 2 and a in entries and b not in entries
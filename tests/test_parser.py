@@ -0,0 +1,106 @@
+from ledger import Amount, Ledger, Transaction
+from parser import FragmentCache, ParseError, Parser, parse_fragments, write_ledger
+import parser
+
+import os
+
+import pytest
+
+
+ledger_text = '''account chk
+category "food:eating out"
+category groceries
+
+2014-05-09 $78.00 from chk "St. Cloud's"
+    take $20.00 from "food:eating out"
+    take $58.00 from groceries
+'''
+
+def _parse(path):
+    p = Parser(path, Ledger())
+    p.parse()
+    txns = [cmd for cmd in p.commands if isinstance(cmd, Transaction)]
+    return (p, txns)
+
+
+def test_update_leaves_unchanged_allocations_alone(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write(ledger_text)
+    (p, [t]) = _parse(path)
+    p.update_transaction(t)
+    assert not any(sc.line.dirty for sc in t.subcommands)
+    write_ledger(p)
+    assert not os.path.exists(path + '_')
+
+
+def test_update_write_round_trip(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write(ledger_text)
+    (p, [t]) = _parse(path)
+    t.allocations['food:eating out'].amount = Amount('25.00')
+    t.allocations['groceries'].amount = Amount('53.00')
+    p.update_transaction(t)
+    write_ledger(p)
+    with open(path + '_') as fp:
+        text = fp.read()
+    assert '    take $25.00 from "food:eating out"\n' in text
+    assert '    take $53.00 from groceries\n' in text
+
+    os.rename(path + '_', path)
+    (p, [t]) = _parse(path)
+    assert sorted((name, a.amount) for (name, a) in t.allocations.items()) == \
+            [('food:eating out', Amount('25.00')), ('groceries', Amount('53.00'))]
+
+
+def _write_tree(tmpdir, years):
+    path = str(tmpdir.join('ledger.dat'))
+    with open(path, 'w') as fp:
+        fp.write('account chk\ncategory rent\n\n')
+        fp.write(''.join('import y%d.dat\n' % y for y in years))
+    for y in years:
+        with open(str(tmpdir.join('y%d.dat' % y)), 'w') as fp:
+            for m in range(1, 13):
+                fp.write('%d-%02d-01 $%d.00 from chk "Rent %d"\n    take all from rent\n\n' % (y, m, m, m))
+    return path
+
+def _raw_lines(p):
+    return [cmd.line.raw_line for cmd in p.commands if getattr(cmd, 'line', None)]
+
+def _parse_pooled(path):
+    fragments = parse_fragments(path, {}, 2)
+    p = Parser(path, Ledger(), FragmentCache(fragments))
+    p.parse()
+    return p
+
+
+def test_pooled_parse_matches_serial(tmpdir, monkeypatch):
+    path = _write_tree(tmpdir, range(2001, 2009))
+    (serial, txns) = _parse(path)
+    monkeypatch.setattr(parser, '_pool_pays', lambda paths, processes: True)
+    p = _parse_pooled(path)
+    assert _raw_lines(p) == _raw_lines(serial)
+    assert [(t.date, t.amount, t.account.name, t.remainder_allocation.category.name)
+            for t in p.ledger.transactions] == \
+            [(t.date, t.amount, t.account.name, t.remainder_allocation.category.name)
+            for t in serial.ledger.transactions]
+    assert all(t.account is p.ledger.accounts['chk'] for t in p.ledger.transactions)
+
+
+def test_pooled_parse_reports_errors_like_serial(tmpdir, monkeypatch):
+    path = _write_tree(tmpdir, range(2001, 2009))
+    with open(str(tmpdir.join('y2005.dat')), 'a') as fp:
+        fp.write('2005-12-31 $1.00 from chk "Bad"\n    take all from food\n')
+    monkeypatch.setattr(parser, '_pool_pays', lambda paths, processes: True)
+    with pytest.raises(ParseError) as serial:
+        _parse(path)
+    with pytest.raises(ParseError) as pooled:
+        _parse_pooled(path)
+    assert (pooled.value.filename, pooled.value.linenum, pooled.value.msg) == \
+            (serial.value.filename, serial.value.linenum, serial.value.msg)
+
+
+def test_small_trees_are_not_parsed_in_a_pool(tmpdir):
+    path = _write_tree(tmpdir, range(2001, 2009))
+    assert parse_fragments(path, {}, 2).keys() == [path]
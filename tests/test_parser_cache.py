@@ -0,0 +1,68 @@
+from parser_cache import load_snapshot, parse_cached, parse_snapshot, snapshot_path
+import parser_cache
+
+import os
+
+
+def _write(path, amount):
+    with open(path, 'w') as fp:
+        fp.write('account chk\nimport year.dat\n')
+    with open(os.path.join(os.path.dirname(path), 'year.dat'), 'w') as fp:
+        fp.write('2014-05-09 $%s from chk "Foo"\n' % amount)
+
+def _amounts(p):
+    return [str(t.amount) for t in p.ledger.transactions]
+
+
+def test_unchanged_files_are_reused(tmpdir):
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path, '5.00')
+    assert _amounts(parse_cached(path)) == ['5.00']
+    snapshot = load_snapshot(path)
+    assert sorted(os.path.basename(f) for f in snapshot.fragments) == ['ledger.dat', 'year.dat']
+    os.utime(snapshot_path(path), (1000, 1000))
+    assert _amounts(parse_cached(path)) == ['5.00']
+    assert os.path.getmtime(snapshot_path(path)) == 1000   # not saved again
+
+
+def test_file_edited_before_the_snapshot_is_saved(tmpdir, monkeypatch):
+    path = str(tmpdir.join('ledger.dat'))
+    _write(path, '5.00')
+    save_snapshot = parser_cache.save_snapshot
+    def edit_then_save(*args):
+        _write(path, '6.00')
+        save_snapshot(*args)
+    monkeypatch.setattr(parser_cache, 'save_snapshot', edit_then_save)
+    assert _amounts(parse_cached(path)) == ['5.00']
+    monkeypatch.undo()
+    assert _amounts(parse_cached(path)) == ['6.00']
+
+
+def _write_months(path):
+    with open(path, 'w') as fp:
+        fp.write('account chk\ncategory rent\n')
+        for (month, day, amount) in [(1, 5, 10), (1, 20, 3), (3, 1, 7), (3, 15, 2), (6, 30, 4)]:
+            fp.write('2014-%02d-%02d $%d into chk "Pay"\n    put $1 into rent\n' % (month, day, amount))
+
+def _balances(p, date):
+    return (p.ledger.date_index().account_balances(date)['chk'].cents,
+            p.ledger.date_index().envelope_balances(date)['rent'].cents)
+
+def test_date_queries_from_snapshotted_checkpoints(tmpdir):
+    import datetime
+    path = str(tmpdir.join('ledger.dat'))
+    _write_months(path)
+    assert parse_snapshot(path) is None   # nothing snapshotted yet
+    parse_cached(path)
+    for (date, expected) in [(None, (2600, 500)), ((2013, 12, 31), (0, 0)),
+            ((2014, 1, 19), (1000, 100)), ((2014, 2, 1), (1300, 200)),
+            ((2014, 3, 15), (2200, 400)), ((2015, 1, 1), (2600, 500))]:
+        date = date and datetime.datetime(*date)
+        p = parse_snapshot(path)
+        assert p.ledger._checkpoints is not None
+        assert _balances(p, date) == expected
+        assert _balances(parse_cached(path), date) == expected
+
+    with open(path, 'a') as fp:
+        fp.write('2014-07-01 $1 into chk "Pay"\n')
+    assert parse_snapshot(path) is None
@@ -0,0 +1,131 @@
+from parser_tokenize import Line, LineParseError
+
+import cPickle as pickle
+import random
+
+
+# The original tokenizer, which walked the line a character at a time; the
+# slice-based one must tokenize every line the same way.
+def _reference_get_token(line, i):
+    i0 = i
+    while True:
+        if i == len(line):
+            return (line[i0:], i)
+        if not str.isspace(line[i]):
+            break
+        i = i + 1
+    i1 = i
+
+    quote  = None
+    escape = None
+    token = ''
+    while True:
+        if i == len(line):
+            if quote:
+                raise LineParseError(i, "unclosed quote")
+            if escape:
+                raise LineParseError(i, "unclosed escape")
+            return ((line[i0:i1], token), i)
+
+        if escape:
+            token = token + line[i]
+            escape = None
+        elif line[i] == quote:
+            quote = None
+        elif line[i] == '#' and not quote:
+            if token == '':
+                return (line[i0:], len(line))
+            break
+        elif str.isspace(line[i]) and not quote:
+            break
+        elif line[i] in '"\'' and not quote:
+            quote = line[i]
+        elif line[i] == '\\' and not quote:
+            escape = '\\'
+        else:
+            token = token + line[i]
+        i = i + 1
+    return ((line[i0:i1], token), i)
+
+def _reference(rawline):
+    tokens = []
+    i = 0
+    try:
+        while True:
+            (tok, i) = _reference_get_token(rawline, i)
+            if isinstance(tok, str):
+                return ('ok', tokens, tok)
+            tokens.append(tok)
+            if i == len(rawline):
+                return ('ok', tokens, '')
+    except LineParseError as e:
+        return ('error', e.index, str(e))
+
+def _tokenized(rawline):
+    try:
+        line = Line(rawline)
+    except LineParseError as e:
+        return ('error', e.index, str(e))
+    return ('ok', [(tok.prefix, tok.value) for tok in line.tokens], line.suffix)
+
+
+lines = [
+    '',
+    '\n',
+    '   \t \n',
+    '# just a comment\n',
+    '    # an indented comment\n',
+    'account jake-chase-chk "Jake\'s Chase Checking Account"\n',
+    'category "food:eating out"\n',
+    '2014-05-01 $55.55 from jake-alaska-cc "23 BARTELL DRUGS  SEA"   # testing filters\n',
+    '    take $28.99 from "food:booze"\n',
+    '    bank_memo: "QFC NO 178"\n',
+    '    tag a#b\n',
+    '    tag "a # b" #c\n',
+    '    desc: \'say "hi"\'\n',
+    '    desc: "it\'s"\n',
+    '    path: C:\\\\dir\\ name\n',
+    'a"b c"d e\n',
+    'tab\tseparated\ttokens\r\n',
+    'trailing space   ',
+    'unclosed "quote\n',
+    'unclosed escape\\',
+    'escaped \\"quote\\" \\# not a comment\n',
+    '""  \'\' empty quotes\n',
+]
+
+def test_known_lines():
+    for rawline in lines:
+        assert _tokenized(rawline) == _reference(rawline), rawline
+
+def test_random_lines():
+    rnd = random.Random(3)
+    alphabet = ' \t\n#"\'\\ab1$.,\r\x0b\x0c-'
+    for _ in xrange(20000):
+        rawline = ''.join(rnd.choice(alphabet) for _ in xrange(rnd.randint(0, 16)))
+        assert _tokenized(rawline) == _reference(rawline), repr(rawline)
+
+def test_rebuild_of_unchanged_line():
+    for rawline in lines:
+        if _reference(rawline)[0] != 'ok' or '"' in rawline or "'" in rawline or '\\' in rawline:
+            continue
+        line = Line(rawline)
+        line.rebuild()
+        assert (line.raw_line, line.dirty) == (rawline, False)
+
+# snapshots pickle lines as their raw text and retokenize them when used
+def test_pickled_lines():
+    for rawline in lines:
+        if _reference(rawline)[0] != 'ok':
+            continue
+        line = pickle.loads(pickle.dumps(Line(rawline), pickle.HIGHEST_PROTOCOL))
+        assert line.__dict__ == {'raw_line': rawline}
+        assert _tokenized(rawline) == ('ok', [(tok.prefix, tok.value) for tok in line.tokens],
+                line.suffix)
+
+    line = Line('    take $28.99 from food\n')
+    line.tokens[1].value = '$30.00'
+    line.rebuild()
+    line = pickle.loads(pickle.dumps(line, pickle.HIGHEST_PROTOCOL))
+    assert (line.raw_line, line.dirty) == ('    take $30.00 from food\n', False)
+    assert line.token_values() == ['take', '$30.00', 'from', 'food']
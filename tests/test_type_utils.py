@@ -0,0 +1,86 @@
+import re
+import datetime
+import random
+
+import type_utils
+
+
+# what datetime_from_str did before it took the fixed-width shapes apart
+def _reference(s):
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:               return datetime.datetime.strptime(s, fmt)
+        except ValueError: pass
+
+def test_datetime_from_str_matches_strptime():
+    rnd = random.Random(5)
+    cases = ['account', 'category', 'import', '', '2014-05-01', '20140501', '2014-02-30',
+            '2014-5-1', '0000-01-01', '2014-13-01', '20141301', '2014-1-011', '2014-05-01 ',
+            ' 2014-05-01', '201451', '2014-05-1', '99991231', '2012-02-29', '2013-02-29']
+    for _ in xrange(20000):
+        cases.append(''.join(rnd.choice('0123456789- x') for _ in xrange(rnd.randint(1, 11))))
+        cases.append(rnd.choice(['%04d-%02d-%02d', '%04d%02d%02d', '%d-%d-%d', '%04d-%d-%02d']) %
+                (rnd.randint(0, 2100), rnd.randint(0, 13), rnd.randint(0, 32)))
+    for s in cases:
+        expected = _reference(s)
+        # the second call is answered from the cache of recent dates
+        assert type_utils.datetime_from_str(s) == expected, repr(s)
+        assert type_utils.datetime_from_str(s) == expected, repr(s)
+
+
+# what cents_from_str did before the split fast path and the cache
+def _reference_cents(s):
+    s = s.strip().translate(None, ',')
+    m = re.match(r"\s*\$?([,\d]+).(\d\d)", s)
+    if m:
+        return int(m.group(1))*100 + int(m.group(2))
+    m = re.match(r"\s*\$?(\d+)", s)
+    if m:
+        return int(m.group(1))*100
+    return None
+
+_cents_table = [
+    ('12.34', 1234), ('$12.34', 1234), ('0.05', 5), ('$0.00', 0), ('.50', None),
+    ('1,234.56', 123456), ('$1,234,567.89', 123456789), ('1,2,3.45', 12345),
+    ('12.3', 1200), ('$7.5', 700), ('12', 1200), ('$12', 1200), ('0', 0),
+    ('  12.34 ', 1234), ('\t$12.34\n', 1234), (' $ 12.34', None),
+    ('-12.34', None), ('$-12.34', None), ('-$12', None),
+    ('', None), ('$', None), ('abc', None), ('.', None), ('$.99', None),
+    ('12.345', 1234), ('12x34', 1234), ('1.2.34', 100), ('12.34abc', 1234), ('12abc', 1200),
+    ('all', None), ('0012.34', 1234)]
+
+def test_cents_from_str_matches_reference_table(monkeypatch):
+    monkeypatch.setattr(type_utils, '_cents_cache', {})
+    for s, expected in _cents_table:
+        assert _reference_cents(s) == expected, repr(s)
+        # the second call is answered from the cache
+        assert type_utils.cents_from_str(s) == expected, repr(s)
+        assert type_utils.cents_from_str(s) == expected, repr(s)
+
+def test_cents_from_str_matches_reference_random(monkeypatch):
+    monkeypatch.setattr(type_utils, '_cents_cache', {})
+    rnd = random.Random(7)
+    for _ in xrange(20000):
+        if rnd.random() < 0.5:
+            s = ''.join(rnd.choice('0123456789.,$- x') for _ in xrange(rnd.randint(0, 9)))
+        else:
+            dollars = rnd.choice(['{}', '{:,}']).format(rnd.randint(0, 10**rnd.randint(1, 9)))
+            s = rnd.choice(['%s.%02d', '$%s.%02d', '%s.%d', ' %s.%02d ', '-%s.%02d']) % \
+                    (dollars, rnd.randint(0, 99))
+            s = rnd.choice([s, dollars, '$' + dollars])
+        assert type_utils.cents_from_str(s) == _reference_cents(s), repr(s)
+
+def test_cents_cache_is_emptied_when_full(monkeypatch):
+    cache = {}
+    monkeypatch.setattr(type_utils, '_cents_cache', cache)
+    size = type_utils._cents_cache_size
+    assert size == 4096
+    for i in xrange(size):
+        assert type_utils.cents_from_str('%d.%02d' % (i, i % 100)) == i*100 + i % 100
+    assert len(cache) == size
+    # the next new literal empties the cache before it is added
+    assert type_utils.cents_from_str('$99999.99') == 9999999
+    assert cache == {'$99999.99': 9999999}
+    # literals parsed before the cache was emptied still parse the same
+    for i in xrange(0, size, 97):
+        assert type_utils.cents_from_str('%d.%02d' % (i, i % 100)) == i*100 + i % 100
+    assert len(cache) == 1 + len(xrange(0, size, 97))
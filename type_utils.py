@@ -6,16 +6,39 @@ from titlecase import titlecase
 
 
 
-def cents_from_str(s):
+_cents_re       = re.compile(r"\s*\$?([,\d]+).(\d\d)")
+_whole_cents_re = re.compile(r"\s*\$?(\d+)")
+
+def _parse_cents(s):
     s = s.strip().translate(None, ',')
-    m = re.match(r"\s*\$?([,\d]+).(\d\d)", s)
+    # the usual '[$]<digits>.<dd>' form is split directly
+    digits = s[1:] if s[0:1] == '$' else s
+    if len(digits) > 3 and digits[-3] == '.' and digits[:-3].isdigit() and digits[-2:].isdigit():
+        return int(digits[:-3])*100 + int(digits[-2:])
+    m = _cents_re.match(s)
     if m:
         return int(m.group(1))*100 + int(m.group(2))
-    m = re.match(r"\s*\$?(\d+)", s)
+    m = _whole_cents_re.match(s)
     if m:
         return int(m.group(1))*100
     return None
 
+# recurring bills and allocations repeat the same literals, so recently
+# parsed ones are kept; the cache is simply emptied when it fills up
+_cents_cache = {}
+_cents_cache_size = 4096
+
+def cents_from_str(s):
+    try:
+        return _cents_cache[s]
+    except KeyError:
+        pass
+    c = _parse_cents(s)
+    if len(_cents_cache) >= _cents_cache_size:
+        _cents_cache.clear()
+    _cents_cache[s] = c
+    return c
+
 def cents_to_str(c):
     if c >= 0:
         return "%d.%02d" % (c//100, c % 100)
@@ -34,26 +57,65 @@ def cents_to_decimal(c):
 def datetime_to_date_str(d):
     return datetime.datetime.strftime(d, '%Y-%m-%d')
 
-def datetime_from_str(str):
+def _strptime_date(str):
     try:               return datetime.datetime.strptime(str, '%Y-%m-%d')
     except ValueError: pass
     try:               return datetime.datetime.strptime(str, '%Y%m%d')
     except ValueError: pass
 
+def _date_from_digits(y, m, d):
+    try:               return datetime.datetime(int(y), int(m), int(d))
+    except ValueError: return None
+
+# ledgers repeat the same dates over and over, so recently seen ones are
+# kept; the cache is simply emptied when it fills up
+_date_cache = {}
+_date_cache_size = 4096
+
+def datetime_from_str(str):
+    d = _date_cache.get(str)
+    if d is not None:
+        return d
+    n = len(str)
+    # the fixed-width YYYY-MM-DD and YYYYMMDD shapes are converted directly
+    if n == 10 and str[4] == '-' and str[7] == '-' and \
+            str[0:4].isdigit() and str[5:7].isdigit() and str[8:10].isdigit():
+        d = _date_from_digits(str[0:4], str[5:7], str[8:10])
+    elif n == 8 and str.isdigit():
+        d = _date_from_digits(str[0:4], str[4:6], str[6:8])
+    elif n == 0 or not str[0].isdigit():
+        # neither format can match unless it starts with the year
+        return None
+    else:
+        d = _strptime_date(str)
+    if d is not None:
+        if len(_date_cache) >= _date_cache_size:
+            _date_cache.clear()
+        _date_cache[str] = d
+    return d
+
+# an integer that orders months chronologically
+def month_key(d):
+    return d.year*12 + d.month - 1
+
 
 
-_safe_re = re.compile('[\'" \t]')
+# what the tokenizer (parser_tokenize) doesn't keep in an unquoted token
+_safe_re = re.compile('[\'"\\s#\\\\]')
 def _find_unsafe(s):
     return _safe_re.search(s)
 
+# Quotes are taken literally between the other kind of quotes, and nothing is
+# escaped inside quotes, so a string with both kinds is written as adjacent
+# quoted pieces, which the tokenizer joins into one token.
 def quote_str(s):
     if '\"' in s and '\'' not in s:
-        return '\'' + s.replace("\"", "\\\"") + '\''
+        return '\'' + s + '\''
     else:
-        return "\"" + s.replace("\"", "\\\"") + "\""
+        return "\"" + s.replace("\"", "\"'\"'\"") + "\""
 
 def quote_str_if_needed(s):
-    return s if not _find_unsafe(s) else quote_str(s)
+    return s if s and not _find_unsafe(s) else quote_str(s)
 
 _acronyms = [
         'TCP', 'UDP',